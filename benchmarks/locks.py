@@ -0,0 +1,154 @@
+"""Concurrency benchmark of the locking and allocation layer.
+
+Every round spawns the given number of processes hammering the operations against a temporary lock dir, and
+reports the throughput, the latency percentiles and the timeout rate of every operation as JSON::
+
+    python benchmarks/locks.py --processes 1 8 32 128 --iterations 100 --allocator registry fcntl daemon
+
+The operations are:
+
+* file_lock: acquisition of the shared lock file
+* get_free_port, get_free_display: allocation of the port or display by the allocator
+* unlock_resource: release of the allocated port
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import zc.lockfile
+
+from pytest_services.allocators import ByteRangeAllocator, DaemonAllocator, RegistryAllocator
+from pytest_services.broker import ensure_daemon
+from pytest_services.locks import display_free, file_lock, free_port_checker
+
+OPERATIONS = ('file_lock', 'get_free_port', 'get_free_display', 'unlock_resource')
+
+services_log = logging.getLogger('benchmark')
+
+
+def get_allocator(name, lock_dir, timeout):
+    """The allocator of the given backend."""
+    if name == 'fcntl':
+        return ByteRangeAllocator(lock_dir, services_log)
+    if name == 'daemon':
+        return DaemonAllocator(os.path.join(lock_dir, 'allocator.sock'), services_log)
+    return RegistryAllocator(lock_dir, services_log, timeout)
+
+
+def measure(samples, operation, function):
+    """Measure the duration of the function call, count the lock timeouts.
+
+    :return: result of the function, None on timeout
+    """
+    start = time.monotonic()
+    try:
+        result = function()
+    except zc.lockfile.LockError:
+        samples[operation]['timeouts'] += 1
+        return None
+    samples[operation]['latencies'].append(time.monotonic() - start)
+    return result
+
+
+def worker(arguments):
+    """Hammer the operations, return the wall time and the samples of every operation."""
+    allocator_name, lock_dir, iterations, timeout, start_event = arguments
+    allocator = get_allocator(allocator_name, lock_dir, timeout)
+    samples = {operation: dict(latencies=[], timeouts=0) for operation in OPERATIONS}
+    start_event.wait()
+    started = time.time()
+    for _ in range(iterations):
+        def lock():
+            with file_lock(os.path.join(lock_dir, 'bench.lock'), remove=False, timeout=timeout):
+                pass
+        measure(samples, 'file_lock', lock)
+        port = measure(
+            samples, 'get_free_port', lambda: allocator.allocate('port', 30000, free_port_checker(), 32768))
+        display = measure(samples, 'get_free_display', lambda: allocator.allocate('display', 100, display_free))
+        if port is not None:
+            measure(samples, 'unlock_resource', lambda: allocator.release('port', port))
+        if display is not None:
+            allocator.release('display', display)
+    return started, time.time(), samples
+
+
+def percentile(values, fraction):
+    """The percentile of the sorted values."""
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_round(allocator_name, processes, iterations, timeout):
+    """Run the round of the processes against a fresh lock dir, return the results of every operation."""
+    lock_dir = tempfile.mkdtemp(prefix='pytest-services-benchmark-')
+    try:
+        if allocator_name == 'daemon':
+            ensure_daemon(
+                'pytest_services.allocator_server', os.path.join(lock_dir, 'allocator.sock'),
+                os.path.join(lock_dir, 'allocator.lock'), ['--idle-timeout', '5'], services_log)
+        manager = multiprocessing.Manager()
+        start_event = manager.Event()
+        with multiprocessing.Pool(processes) as pool:
+            result = pool.map_async(
+                worker, [(allocator_name, lock_dir, iterations, timeout, start_event)] * processes, chunksize=1)
+            start_event.set()
+            workers = result.get()
+        manager.shutdown()
+    finally:
+        shutil.rmtree(lock_dir, ignore_errors=True)
+
+    duration = max(end for _, end, _ in workers) - min(start for start, _, _ in workers)
+    results = []
+    for operation in OPERATIONS:
+        latencies = sorted(sum((samples[operation]['latencies'] for _, _, samples in workers), []))
+        timeouts = sum(samples[operation]['timeouts'] for _, _, samples in workers)
+        attempts = len(latencies) + timeouts
+        results.append(dict(
+            allocator=allocator_name,
+            processes=processes,
+            operation=operation,
+            count=len(latencies),
+            throughput=len(latencies) / duration if duration else None,
+            p50=percentile(latencies, 0.5),
+            p99=percentile(latencies, 0.99),
+            timeout_rate=timeouts / attempts if attempts else 0.0,
+        ))
+    return results
+
+
+def main(args=None):
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description='pytest-services locking and allocation benchmark')
+    parser.add_argument(
+        '--processes', type=int, nargs='+', default=[1, 8, 32, 128], help='numbers of the concurrent processes')
+    parser.add_argument('--iterations', type=int, default=100, help='number of the iterations of every process')
+    parser.add_argument(
+        '--allocator', nargs='+', default=['registry'], choices=['registry', 'fcntl', 'daemon'],
+        help='allocator backends to compare')
+    parser.add_argument('--timeout', type=float, default=20, help='lock timeout in seconds')
+    parser.add_argument('--output', help='JSON file to write the results to, standard output by default')
+    options = parser.parse_args(args)
+
+    results = [
+        result
+        for allocator_name in options.allocator
+        for processes in options.processes
+        for result in run_round(allocator_name, processes, options.iterations, options.timeout)
+    ]
+    if options.output:
+        with open(options.output, 'w') as fd:
+            json.dump(results, fd, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Allocator daemon of the resources (ports, displays) shared between the test sessions on the host.
+
+The daemon listens on a unix socket and keeps the index of the allocated resources in memory. The resources are
+leased by the client connection, they are released when the client releases them or closes the connection,
+for example when the test session crashes. The daemon exits when it has no clients for the idle timeout.
+
+The protocol is a JSON object per line, the client sends the requests::
+
+    {"op": "allocate", "name": "port", "start": 30000, "end": 32768, "count": 2, "contiguous": false}
+    {"op": "release", "name": "port", "resources": [30000, 30001]}
+
+and the daemon responds with `{"resources": [...]}` or `{"error": "..."}`.
+
+Run the daemon with::
+
+    python -m pytest_services.allocator_server --socket /dev/shm/resource-allocator.sock --idle-timeout 600
+"""
+import argparse
+import bisect
+import json
+import os
+import signal
+import socketserver
+import threading
+import time
+
+
+class ResourceIndex(object):
+
+    """Sorted index of the allocated resources and their owners."""
+
+    def __init__(self):
+        """Initialize the index."""
+        self.lock = threading.Lock()
+        self.allocated = {}
+        self.owners = {}
+        self.clients = 0
+        self.idle_since = time.monotonic()
+
+    def allocate(self, owner, name, start, count, contiguous=False, end=None):
+        """Allocate the lowest resources which are not allocated yet.
+
+        :param owner: the client owning the resources
+        :param name: name to be used to separate various resources, eg. port, display
+        :param start: the lowest resource
+        :param count: number of the resources
+        :param contiguous: whether the resources have to form a contiguous block
+        :param end: the resource after the highest one, unbounded by default
+        :return: list of the resources
+        :raise ValueError: when there are not enough resources below the end
+        """
+        with self.lock:
+            allocated = self.allocated.setdefault(name, [])
+            resources = []
+            resource = start
+            index = bisect.bisect_left(allocated, resource)
+            while len(resources) < count:
+                if end is not None and resource >= end:
+                    raise ValueError('there are no {0} free resources in the range {1}-{2}'.format(
+                        count, start, end - 1))
+                if index < len(allocated) and allocated[index] == resource:
+                    index += 1
+                    if contiguous:
+                        resources = []
+                else:
+                    resources.append(resource)
+                resource += 1
+            for resource in resources:
+                bisect.insort(allocated, resource)
+                self.owners[(name, resource)] = owner
+            return resources
+
+    def release(self, owner, name, resources):
+        """Release the resources of the owner."""
+        with self.lock:
+            allocated = self.allocated.get(name, [])
+            for resource in resources:
+                if self.owners.get((name, resource)) is owner:
+                    del self.owners[(name, resource)]
+                    del allocated[bisect.bisect_left(allocated, resource)]
+
+    def release_all(self, owner):
+        """Release all the resources of the owner."""
+        with self.lock:
+            owned = [key for key, value in self.owners.items() if value is owner]
+        for name, resource in owned:
+            self.release(owner, name, [resource])
+
+    def connected(self):
+        """Count the connected client."""
+        with self.lock:
+            self.clients += 1
+
+    def disconnected(self):
+        """Count the disconnected client."""
+        with self.lock:
+            self.clients -= 1
+            if not self.clients:
+                self.idle_since = time.monotonic()
+
+    def idle(self, timeout):
+        """Check whether there were no clients for the timeout."""
+        with self.lock:
+            return not self.clients and time.monotonic() - self.idle_since > timeout
+
+
+class AllocatorHandler(socketserver.StreamRequestHandler):
+
+    """Handler of the client connection, the resources are leased until the connection is closed."""
+
+    def handle(self):
+        """Serve the requests of the client."""
+        index = self.server.index
+        index.connected()
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    if request['op'] == 'allocate':
+                        resources = index.allocate(
+                            self, request['name'], request['start'], request['count'],
+                            request.get('contiguous', False), request.get('end'))
+                    elif request['op'] == 'release':
+                        index.release(self, request['name'], request['resources'])
+                        resources = request['resources']
+                    else:
+                        raise ValueError('unknown operation {0!r}'.format(request['op']))
+                except (ValueError, KeyError, TypeError) as err:
+                    self.respond(error=str(err))
+                else:
+                    self.respond(resources=resources)
+        finally:
+            index.release_all(self)
+            index.disconnected()
+
+    def respond(self, **response):
+        """Send the response to the client."""
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+class AllocatorServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    """Unix socket server of the allocator."""
+
+    daemon_threads = True
+
+    def __init__(self, path, index):
+        """Bind the server, the socket is connectable by all the users sharing the resources on the host."""
+        socketserver.UnixStreamServer.__init__(self, path, AllocatorHandler)
+        os.chmod(path, 0o666)
+        self.index = index
+
+
+def main(args=None):
+    """Run the allocator daemon."""
+    parser = argparse.ArgumentParser(description='pytest-services resource allocator')
+    parser.add_argument('--socket', required=True, help='unix socket to listen on')
+    parser.add_argument(
+        '--idle-timeout', type=float, default=600,
+        help='number of seconds without clients after which the allocator exits')
+    options = parser.parse_args(args)
+
+    server = AllocatorServer(options.socket, ResourceIndex())
+
+    def shutdown(*args):
+        threading.Thread(target=server.shutdown).start()
+
+    def reaper():
+        while not server.index.idle(options.idle_timeout):
+            time.sleep(1)
+        shutdown()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    threading.Thread(target=reaper, daemon=True).start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(options.socket)
+
+
+if __name__ == '__main__':
+    main()
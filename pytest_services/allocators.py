@@ -0,0 +1,368 @@
+"""Allocators of the resources (ports, displays) shared between the test sessions on the host."""
+import contextlib
+import json
+import os
+import socket
+import threading
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+import pytest
+
+from .broker import connect_broker, ensure_daemon
+from .locks import (
+    lock_resource,
+    lock_resources,
+    next_free_resource,
+    next_free_resources,
+    parse_port_range,
+    unlock_resources,
+)
+from .service import worker_index
+
+
+class RegistryAllocator(object):
+
+    """Allocate the resources through the shared list of the bound resources in the lock dir.
+
+    The list is locked, parsed and rewritten on every allocation and release.
+    """
+
+    def __init__(self, lock_dir, services_log, lock_resource_timeout, session_id=None):
+        """Assign the lock dir."""
+        self.lock_dir = lock_dir
+        self.services_log = services_log
+        self.lock_resource_timeout = lock_resource_timeout
+        self.session_id = session_id
+
+    def allocate(self, name, start, is_free, end=None):
+        """Allocate the lowest free resource.
+
+        :param name: name to be used to separate various resources, eg. port, display
+        :param start: the lowest resource
+        :param is_free: function checking whether the resource is not used by someone else
+        :param end: the resource after the highest one, unbounded by default
+        """
+        def get_resource(bound_resources):
+            return next_free_resource(bound_resources, start, is_free, end)
+
+        return lock_resource(
+            name, get_resource, self.lock_dir, self.services_log, self.lock_resource_timeout, self.session_id)
+
+    def allocate_many(self, name, start, is_free, count, contiguous=False, end=None):
+        """Allocate several free resources by a single update of the list.
+
+        :param count: number of the resources
+        :param contiguous: whether the resources have to form a contiguous block
+        :return: list of the resources
+        """
+        def get_resources(bound_resources):
+            return next_free_resources(bound_resources, start, is_free, count, contiguous, end)
+
+        return lock_resources(
+            name, get_resources, self.lock_dir, self.services_log, self.lock_resource_timeout, self.session_id)
+
+    def release(self, name, *resources):
+        """Release the allocated resources."""
+        unlock_resources(name, resources, self.lock_dir, self.services_log)
+
+
+class ByteRangeAllocator(object):
+
+    """Allocate every resource by an exclusive fcntl lock of its own byte in a sparse file in the lock dir.
+
+    The resource N is held by the lock of the byte at offset N of the `<name>.ranges` file. The kernel releases
+    the locks when the process dies, so the resources of the crashed sessions are never leaked, and the cost of
+    the allocation doesn't depend on the number of the bound resources.
+
+    The fcntl locks are owned by the process and released when any descriptor of the file is closed, so the
+    descriptors and the allocated resources are shared by all the allocators of the process.
+    """
+
+    lock = threading.Lock()
+    descriptors = {}
+    held = set()
+
+    def __init__(self, lock_dir, services_log):
+        """Assign the lock dir."""
+        assert fcntl is not None, 'fcntl locks are not supported on this platform.'
+        self.lock_dir = lock_dir
+        self.services_log = services_log
+
+    def descriptor(self, name):
+        """The descriptor of the ranges file of the resource, opened once per process."""
+        path = os.path.join(self.lock_dir, '{0}.ranges'.format(name))
+        if path not in self.descriptors:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                os.fchmod(fd, 0o666)  # shared by the users of the lock dir
+            except OSError:
+                pass
+            self.descriptors[path] = fd
+        return path, self.descriptors[path]
+
+    def allocate(self, name, start, is_free, end=None):
+        """Allocate the lowest free resource.
+
+        :param name: name to be used to separate various resources, eg. port, display
+        :param start: the lowest resource
+        :param is_free: function checking whether the resource is not used by someone else
+        :param end: the resource after the highest one, unbounded by default
+        """
+        return self.allocate_many(name, start, is_free, 1, end=end)[0]
+
+    def allocate_many(self, name, start, is_free, count, contiguous=False, end=None):
+        """Allocate several free resources.
+
+        :param count: number of the resources
+        :param contiguous: whether the resources have to form a contiguous block
+        :return: list of the resources
+        """
+        with self.lock:
+            path, fd = self.descriptor(name)
+            resources = []
+            resource = start
+            while len(resources) < count:
+                if end is not None and resource >= end:
+                    self.unlock(path, fd, *resources)
+                    raise Exception('There are no {0} free {1} resources in the range {2}-{3}.'.format(
+                        count, name, start, end - 1))
+                if self.try_lock(path, fd, resource, is_free):
+                    resources.append(resource)
+                elif contiguous and resources:
+                    self.unlock(path, fd, *resources)
+                    resources = []
+                resource += 1
+            self.held.update((path, resource) for resource in resources)
+            self.services_log.debug('resources locked {0}: {1}'.format(name, resources))
+            return resources
+
+    def try_lock(self, path, fd, resource, is_free):
+        """Lock the byte of the resource if it's free."""
+        if (path, resource) in self.held:
+            return False
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, resource)
+        except OSError:
+            return False
+        if is_free(resource):
+            return True
+        fcntl.lockf(fd, fcntl.LOCK_UN, 1, resource)
+        return False
+
+    def unlock(self, path, fd, *resources):
+        """Unlock the bytes of the resources."""
+        for resource in resources:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1, resource)
+            self.held.discard((path, resource))
+
+    def release(self, name, *resources):
+        """Release the allocated resources."""
+        with self.lock:
+            path, fd = self.descriptor(name)
+            held = [resource for resource in resources if (path, resource) in self.held]
+            self.unlock(path, fd, *held)
+            self.services_log.debug('resources freed {0}: {1}'.format(name, held))
+
+
+class PartitionAllocator(object):
+
+    """Allocate the ports from the slice of the port range owned by the worker, without the inter-process locks.
+
+    The port range is split into the disjoint slices of the given size. The worker claims a slice once, in the
+    shared registry of the slices in the lock dir, preferring the slice of its own index so the slices are stable
+    between the runs. The ports of the slice are then allocated by a scan of the slice protected by a thread lock,
+    the only probe being the bind of the port. When the slice is exhausted, or all the slices are claimed by the
+    other sessions, the ports are allocated by the shared allocator. Other resources are always allocated by the
+    shared allocator.
+    """
+
+    def __init__(
+            self, allocator, lock_dir, services_log, lock_resource_timeout, worker_id, session_id=None,
+            port_range=(20000, 30000), size=100):
+        """Assign the shared allocator and the port range.
+
+        :param allocator: the shared allocator
+        :param port_range: tuple of the first port and the port after the last one of the range
+        :param size: number of the ports in a slice
+        """
+        self.allocator = allocator
+        self.lock_dir = lock_dir
+        self.services_log = services_log
+        self.lock_resource_timeout = lock_resource_timeout
+        self.worker_id = worker_id
+        self.session_id = session_id
+        self.port_range = port_range
+        self.size = size
+        self.lock = threading.Lock()
+        self.partition = None
+        self.held = set()
+
+    def slices(self):
+        """Number of the slices in the port range."""
+        return (self.port_range[1] - self.port_range[0]) // self.size
+
+    def preferred_slice(self):
+        """The slice of the worker index, eg. 3 for `gw3` and 0 for `local`."""
+        return worker_index(self.worker_id) % self.slices()
+
+    def claim(self):
+        """Claim the slice of the port range in the shared registry, once per allocator.
+
+        :return: range of the ports of the slice or an empty range if all the slices are claimed
+        """
+        if self.partition is None:
+            def get_slice(bound_slices):
+                preferred = self.preferred_slice()
+                free = [index for index in range(self.slices()) if index not in bound_slices]
+                return [preferred if preferred in free else free[0]] if free else []
+
+            claimed = lock_resources(
+                'port-partition', get_slice, self.lock_dir, self.services_log, self.lock_resource_timeout,
+                self.session_id)
+            if claimed:
+                start = self.port_range[0] + claimed[0] * self.size
+                self.partition = range(start, start + self.size)
+            else:
+                self.partition = range(0)
+            self.services_log.debug('port partition claimed: {0}'.format(self.partition))
+        return self.partition
+
+    def allocate(self, name, start, is_free, end=None):
+        """Allocate the free resource, see `RegistryAllocator.allocate`."""
+        return self.allocate_many(name, start, is_free, 1, end=end)[0]
+
+    def allocate_many(self, name, start, is_free, count, contiguous=False, end=None):
+        """Allocate several free resources, see `RegistryAllocator.allocate_many`."""
+        if name == 'port':
+            with self.lock:
+                ports = []
+                for port in self.claim():
+                    if port not in self.held and is_free(port):
+                        ports.append(port)
+                    elif contiguous:
+                        ports = []
+                    if len(ports) == count:
+                        self.held.update(ports)
+                        self.services_log.debug('resources allocated from partition {0}: {1}'.format(name, ports))
+                        return ports
+        return self.allocator.allocate_many(name, start, is_free, count, contiguous, end)
+
+    def release(self, name, *resources):
+        """Release the allocated resources."""
+        if name == 'port':
+            with self.lock:
+                partitioned = [resource for resource in resources if resource in self.held]
+                self.held.difference_update(partitioned)
+            resources = [resource for resource in resources if resource not in partitioned]
+        if resources:
+            self.allocator.release(name, *resources)
+
+    def close(self):
+        """Release the claimed slice."""
+        if self.partition:
+            unlock_resources(
+                'port-partition', [(self.partition.start - self.port_range[0]) // self.size], self.lock_dir,
+                self.services_log)
+        self.partition = None
+
+
+class DaemonAllocator(object):
+
+    """Allocate the resources from the allocator daemon, see `pytest_services.allocator_server`.
+
+    The resources are leased by the connection of the allocator to the daemon, so they are released when the
+    process dies. The daemon doesn't know which resources are used by someone else, so the candidates it
+    allocates are checked by the client, and the used ones are kept allocated until the allocation is done
+    so they are not offered again.
+    """
+
+    def __init__(self, path, services_log):
+        """Connect to the daemon listening on the given socket."""
+        self.services_log = services_log
+        self.lock = threading.Lock()
+        self.connection = connect_broker(path)
+        self.rfile = self.connection.makefile('rb')
+
+    def request(self, **request):
+        """Send the request to the daemon and read the response."""
+        with self.lock:
+            self.connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            line = self.rfile.readline()
+        response = json.loads(line.decode('utf-8')) if line else {'error': 'allocator closed the connection'}
+        if 'error' in response:
+            raise Exception('Resource allocator failed to {0} {1}: {2}'.format(
+                request['op'], request['name'], response['error']))
+        return response['resources']
+
+    def allocate(self, name, start, is_free, end=None):
+        """Allocate the free resource, see `RegistryAllocator.allocate`."""
+        return self.allocate_many(name, start, is_free, 1, end=end)[0]
+
+    def allocate_many(self, name, start, is_free, count, contiguous=False, end=None):
+        """Allocate several free resources, see `RegistryAllocator.allocate_many`."""
+        resources = []
+        used = []
+        try:
+            while len(resources) < count:
+                candidates = self.request(
+                    op='allocate', name=name, start=start, end=end, count=count - len(resources),
+                    contiguous=contiguous)
+                if contiguous:
+                    if all(is_free(resource) for resource in candidates):
+                        resources = candidates
+                    else:
+                        used.extend(candidates)
+                    continue
+                for resource in candidates:
+                    (resources if is_free(resource) else used).append(resource)
+        finally:
+            if used:
+                self.request(op='release', name=name, resources=used)
+        self.services_log.debug('resources allocated {0}: {1}'.format(name, resources))
+        return resources
+
+    def release(self, name, *resources):
+        """Release the allocated resources."""
+        self.request(op='release', name=name, resources=list(resources))
+        self.services_log.debug('resources freed {0}: {1}'.format(name, list(resources)))
+
+    def close(self):
+        """Close the connection, releasing all the resources."""
+        with contextlib.suppress(OSError):
+            # Wait for the daemon to close the connection after releasing the resources.
+            self.connection.shutdown(socket.SHUT_WR)
+            self.connection.settimeout(10)
+            self.rfile.read()
+        self.rfile.close()
+        self.connection.close()
+
+
+@pytest.fixture(scope='session')
+def resource_allocator(
+        request, memory_root_dir, lock_dir, services_log, lock_resource_timeout, worker_id, session_id):
+    """Allocator of the resources used by the `port_getter` and the `display_getter`.
+
+    See `--services-allocator` and `--services-port-partitions` options.
+    """
+    if request.config.option.services_allocator == 'fcntl':
+        allocator = ByteRangeAllocator(lock_dir, services_log)
+    elif request.config.option.services_allocator == 'daemon':
+        path = os.path.join(memory_root_dir, 'resource-allocator.sock')
+        ensure_daemon(
+            'pytest_services.allocator_server', path, os.path.join(lock_dir, 'resource-allocator.lock'), [],
+            services_log)
+        allocator = DaemonAllocator(path, services_log)
+        request.addfinalizer(allocator.close)
+    else:
+        allocator = RegistryAllocator(lock_dir, services_log, lock_resource_timeout, session_id)
+    if request.config.option.services_port_partitions:
+        allocator = PartitionAllocator(
+            allocator, lock_dir, services_log, lock_resource_timeout, worker_id, session_id,
+            port_range=parse_port_range(request.config.option.services_port_partitions_range),
+            size=request.config.option.services_port_partitions,
+        )
+        request.addfinalizer(allocator.close)
+    return allocator
@@ -0,0 +1,118 @@
+"""Asyncio service fixtures."""
+import asyncio
+import functools
+import inspect
+import time
+import warnings
+
+import psutil
+import pytest
+
+from .probes import which
+from .service import poll_delays
+
+
+async def async_wait_for_service(name, watcher, checker, timeout, schedule):
+    """Wait for the service to start without blocking the event loop.
+
+    :param name: service name used in the error messages
+    :param watcher: asyncio Process object of the service
+    :param checker: callable or coroutine function returning True when the service is ready
+    :param timeout: number of seconds to wait for the service
+    :param schedule: polling schedule, see `watcher_poll_schedule`
+    :return: tuple in form `(seconds it took to become ready, number of checker attempts)`
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    attempts = 0
+    for delay in poll_delays(schedule):
+        attempts += 1
+        ready = checker()
+        if inspect.isawaitable(ready):
+            ready = await ready
+        if ready:
+            return time.monotonic() - start, attempts
+
+        if watcher.returncode is not None:
+            raise Exception("Error running {0}".format(name))
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception('The {0} service checked did not succeed!'.format(name))
+
+        await asyncio.sleep(min(delay, remaining))
+
+
+async def stop_async_watcher(watcher, timeout):
+    """Terminate the service process, kill it if it doesn't exit in time."""
+    if watcher.returncode is not None:
+        return
+    try:
+        watcher.terminate()
+    except ProcessLookupError:
+        pass
+    try:
+        await asyncio.wait_for(watcher.wait(), timeout / 2)
+    except asyncio.TimeoutError:
+        watcher.kill()
+        await asyncio.wait_for(watcher.wait(), timeout / 2)
+
+
+def stop_process(pid, timeout):
+    """Terminate the process by its pid, kill it if it doesn't exit in time."""
+    try:
+        process = psutil.Process(pid)
+        process.terminate()
+        try:
+            process.wait(timeout / 2)
+        except psutil.TimeoutExpired:
+            process.kill()
+            process.wait(timeout / 2)
+    except psutil.NoSuchProcess:
+        pass
+
+
+@pytest.fixture(scope='session')
+def async_watcher_getter(request, services_log, watcher_poll_schedule):
+    """Coroutine function starting the service with asyncio, an async variant of the `watcher_getter`.
+
+    Wait for the process to start without blocking the event loop.
+    The returned asyncio Process object has a `stop` coroutine function to stop the service from the async
+    finalizers. Services which were not stopped are stopped by the request finalizer.
+    """
+    orig_request = request
+
+    async def async_watcher_getter_function(
+            name, arguments=None, kwargs=None, timeout=20, checker=None, request=None):
+        if request is None:
+            warnings.warn('Omitting the `request` parameter will result in an unstable order of finalizers.')
+            request = orig_request
+        executable = which(name)
+        assert executable, 'You have to install {0} executable.'.format(name)
+
+        cmd = [name] + (arguments or [])
+
+        services_log.debug('Starting {0}: {1}'.format(name, arguments))
+
+        loop = asyncio.get_running_loop()
+        watcher = await asyncio.create_subprocess_exec(
+            *cmd, **(kwargs or {}))
+        watcher.stop = functools.partial(stop_async_watcher, watcher, timeout)
+
+        def finalize():
+            if watcher.returncode is not None:
+                return
+            if not loop.is_closed() and not loop.is_running():
+                loop.run_until_complete(watcher.stop())
+            else:
+                stop_process(watcher.pid, timeout)
+        request.addfinalizer(finalize)
+
+        watcher.startup_duration, attempts = await async_wait_for_service(
+            name, watcher, checker, timeout, watcher_poll_schedule)
+        services_log.debug('{0} is ready in {1:.3f}s after {2} checks'.format(
+            name, watcher.startup_duration, attempts))
+
+        return watcher
+
+    return async_watcher_getter_function
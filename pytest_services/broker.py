@@ -0,0 +1,398 @@
+"""Persistent service broker, reusing warm services across test sessions.
+
+The broker is a daemon listening on a unix socket. It owns long-lived service processes keyed by a hash of
+their command line, environment and defaults file. A test session leases a service instance by keeping its
+connection to the broker open, the instance is kept running when the connection is closed and it is
+reclaimed after the idle timeout. The broker exits when it doesn't own any service for the idle timeout.
+
+Run the broker with::
+
+    python -m pytest_services.broker --socket /dev/shm/service-broker.sock --idle-timeout 600
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+try:
+    import subprocess32 as subprocess
+except ImportError:  # pragma: no cover
+    import subprocess
+
+import psutil
+import pytest
+
+from .locks import file_lock
+
+DEFAULTS_FILE_OPTIONS = ('--defaults-file=', '--defaults-extra-file=')
+
+
+def service_key(cmd, cwd=None, env=None):
+    """Hash of the service command line, environment and the contents of its defaults files."""
+    digest = hashlib.sha1(json.dumps([cmd, cwd, env], sort_keys=True).encode('utf-8'))
+    for argument in cmd:
+        for option in DEFAULTS_FILE_OPTIONS:
+            if argument.startswith(option):
+                with open(argument[len(option):], 'rb') as fd:
+                    digest.update(fd.read())
+    return digest.hexdigest()
+
+
+def stop_service(process, timeout=10):
+    """Terminate the service process, kill it if it doesn't exit in time."""
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait(timeout)
+
+
+class Instance(object):
+
+    """Service process owned by the broker."""
+
+    def __init__(self, process):
+        """Assign the process."""
+        self.process = process
+        self.leased = False
+        self.idle_since = time.monotonic()
+
+
+class Broker(object):
+
+    """Registry of the service instances owned by the broker."""
+
+    def __init__(self, idle_timeout):
+        """Assign the idle timeout."""
+        self.idle_timeout = idle_timeout
+        self.instances = {}
+        self.lock = threading.Lock()
+        self.last_activity = time.monotonic()
+
+    def lease(self, request):
+        """Lease the service instance, starting it if needed.
+
+        :return: tuple in form `(instance, whether it was already running)`, None if the instance is leased
+            by another session
+        """
+        key = request['key']
+        with self.lock:
+            self.last_activity = time.monotonic()
+            instance = self.instances.get(key)
+            if instance is not None and instance.process.poll() is not None:
+                del self.instances[key]
+                instance = None
+            warm = instance is not None
+            if instance is None:
+                instance = self.instances[key] = Instance(subprocess.Popen(
+                    request['cmd'],
+                    cwd=request.get('cwd'),
+                    env=request.get('env'),
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    start_new_session=True,
+                ))
+            elif instance.leased:
+                return None
+            instance.leased = True
+            return instance, warm
+
+    def release(self, instance):
+        """Release the lease of the service instance."""
+        with self.lock:
+            instance.leased = False
+            instance.idle_since = self.last_activity = time.monotonic()
+
+    def reap(self):
+        """Stop the instances idle for longer than the idle timeout.
+
+        :return: whether the broker itself has been idle for longer than the idle timeout
+        """
+        expired = []
+        with self.lock:
+            now = time.monotonic()
+            for key, instance in list(self.instances.items()):
+                if instance.process.poll() is not None:
+                    del self.instances[key]
+                elif not instance.leased and now - instance.idle_since > self.idle_timeout:
+                    expired.append(self.instances.pop(key))
+            if self.instances:
+                self.last_activity = now
+            idle = not self.instances and now - self.last_activity > self.idle_timeout
+        for instance in expired:
+            stop_service(instance.process)
+        return idle
+
+    def stop(self):
+        """Stop all the instances."""
+        with self.lock:
+            instances, self.instances = list(self.instances.values()), {}
+        for instance in instances:
+            stop_service(instance.process)
+
+
+def peer_uid(sock):
+    """The uid of the process on the other side of the unix socket, None if the platform doesn't tell."""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', credentials)[1]
+
+
+class LeaseHandler(socketserver.StreamRequestHandler):
+
+    """Hold the lease of the service instance for the lifetime of the client connection."""
+
+    def handle(self):
+        """Lease the instance, release it when the client disconnects.
+
+        The instance requested with `prewarm` is only started and released right away. The broker runs the
+        commands of the clients, so only the processes of the broker's user are served.
+        """
+        uid = peer_uid(self.request)
+        if uid is not None and uid != os.getuid():
+            self.respond(error='the broker serves only the uid {0}'.format(os.getuid()))
+            return
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            result = self.server.broker.lease(request)
+        except (ValueError, KeyError, OSError) as err:
+            self.respond(error=str(err))
+            return
+        if result is None:
+            self.respond(busy=True)
+            return
+        instance, warm = result
+        if request.get('prewarm'):
+            # released before the response, so the instance can be leased as soon as the client knows it's running
+            self.server.broker.release(instance)
+            self.respond(pid=instance.process.pid, warm=warm)
+            return
+        try:
+            self.respond(pid=instance.process.pid, warm=warm)
+            self.rfile.read()
+        finally:
+            self.server.broker.release(instance)
+
+    def respond(self, **response):
+        """Send the response to the client."""
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    """Unix socket server of the broker."""
+
+    daemon_threads = True
+
+    def __init__(self, path, broker):
+        """Bind the server, the socket is accessible only by the broker's user."""
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, LeaseHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o600)
+        self.broker = broker
+
+
+class BrokerLease(object):
+
+    """Lease of the service instance owned by the broker, used in place of the Popen object of the service."""
+
+    def __init__(self, connection, pid, warm):
+        """Assign the lease attributes."""
+        self.connection = connection
+        self.pid = pid
+        self.warm = warm
+        self.returncode = None
+
+    def poll(self):
+        """Check whether the service is still running."""
+        if self.returncode is None and not psutil.pid_exists(self.pid):
+            self.returncode = -1
+        return self.returncode
+
+    def terminate(self):
+        """Release the lease, the service is kept running by the broker."""
+        if self.connection is not None:
+            try:
+                # Wait for the broker to close the connection after releasing the lease.
+                self.connection.shutdown(socket.SHUT_WR)
+                self.connection.settimeout(10)
+                self.connection.recv(1)
+            except socket.error:
+                pass
+            self.connection.close()
+            self.connection = None
+        if self.returncode is None:
+            self.returncode = 0
+
+    kill = terminate
+
+    def communicate(self, timeout=None):
+        """Nothing to communicate with the leased service."""
+        return None, None
+
+    def wait(self, timeout=None):
+        """Return the return code, the leased service is not waited for."""
+        return self.returncode
+
+
+def connect_broker(path):
+    """Connect to the broker listening on the given socket."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except socket.error:
+        connection.close()
+        raise
+    return connection
+
+
+def lease_service(path, cmd, cwd=None, env=None):
+    """Lease the service instance from the broker.
+
+    :param path: the broker socket
+    :param cmd: command line of the service, the executable should be given by its absolute path
+    :return: `BrokerLease` object, None if the instance is leased by another session
+    """
+    connection = connect_broker(path)
+    request = dict(key=service_key(cmd, cwd, env), cmd=cmd, cwd=cwd, env=env)
+    connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+    line = connection.makefile('rb').readline()
+    response = json.loads(line.decode('utf-8')) if line else {'error': 'broker closed the connection'}
+    if 'pid' not in response:
+        connection.close()
+        if 'error' in response:
+            raise Exception('Service broker failed to start {0}: {1}'.format(cmd[0], response['error']))
+        return None
+    return BrokerLease(connection, response['pid'], response['warm'])
+
+
+def prewarm_service(path, cmd, cwd=None, env=None):
+    """Start the service instance by the broker unless it is already running, without leasing it.
+
+    :return: whether the instance is running, False if it is leased by another session
+    """
+    with contextlib.closing(connect_broker(path)) as connection:
+        request = dict(key=service_key(cmd, cwd, env), cmd=cmd, cwd=cwd, env=env, prewarm=True)
+        connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        line = connection.makefile('rb').readline()
+    return 'pid' in json.loads(line.decode('utf-8')) if line else False
+
+
+def get_broker_socket(memory_root_dir):
+    """The socket of the service broker of the current user.
+
+    The services are owned by the user, so every user sharing the host has a broker of their own.
+    """
+    return os.path.join(memory_root_dir, 'service-broker-{0}.sock'.format(os.getuid()))
+
+
+def wait_for_broker(path, timeout):
+    """Wait for the broker to accept connections.
+
+    :return: whether the broker is running
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            connect_broker(path).close()
+            return True
+        except socket.error:
+            if time.monotonic() > deadline:
+                return False
+        time.sleep(0.01)
+
+
+def ensure_daemon(module, path, lock_path, arguments, services_log):
+    """Start the daemon module listening on the given socket unless it is already running.
+
+    :param module: name of the module run by `python -m`, it's given the `--socket` option
+    :param lock_path: lock file preventing the concurrent sessions from starting the daemon twice
+    :param arguments: other arguments of the daemon
+    """
+    if wait_for_broker(path, 0):
+        return
+    with file_lock(lock_path):
+        if wait_for_broker(path, 0):
+            return
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        services_log.debug('starting {0}: {1}'.format(module, path))
+        subprocess.Popen(
+            [sys.executable, '-m', module, '--socket', path] + list(arguments),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        assert wait_for_broker(path, 10), 'The {0} did not start.'.format(module)
+
+
+def ensure_broker(path, lock_dir, idle_timeout, services_log):
+    """Start the broker listening on the given socket unless it is already running."""
+    ensure_daemon(
+        __name__, path, os.path.join(lock_dir, 'service-broker-{0}.lock'.format(os.getuid())),
+        ['--idle-timeout', str(idle_timeout)], services_log)
+
+
+@pytest.fixture(scope='session')
+def services_broker(request, memory_root_dir, lock_dir, services_log):
+    """The socket of the service broker, None if the broker is not enabled.
+
+    The broker is started on demand.
+    """
+    if not request.config.option.services_broker:
+        return None
+    path = get_broker_socket(memory_root_dir)
+    ensure_broker(path, lock_dir, request.config.option.services_broker_idle_timeout, services_log)
+    return path
+
+
+def main(args=None):
+    """Run the broker."""
+    parser = argparse.ArgumentParser(description='pytest-services service broker')
+    parser.add_argument('--socket', required=True, help='unix socket to listen on')
+    parser.add_argument(
+        '--idle-timeout', type=float, default=600,
+        help='number of seconds after which the idle services and the broker itself are stopped')
+    options = parser.parse_args(args)
+
+    broker = Broker(options.idle_timeout)
+    server = BrokerServer(options.socket, broker)
+
+    def shutdown(*args):
+        threading.Thread(target=server.shutdown).start()
+
+    def reaper():
+        while not broker.reap():
+            time.sleep(1)
+        shutdown()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    threading.Thread(target=reaper, daemon=True).start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(options.socket)
+        broker.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""Service readiness checkers.
+
+A checker is a callable returning True when the service is ready. A checker can also provide a
+`wait(timeout)` method, blocking until the service is ready or the timeout expires, which is used by
+the `watcher_getter` instead of sleeping between the checks.
+"""
+import abc
+import contextlib
+import ctypes
+import ctypes.util
+import http.client
+import os
+import select
+import socket
+import time
+import urllib.parse
+
+from .service import poll_delays
+
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+def load_libc():
+    """Load the C library if it provides the inotify API."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+libc = load_libc()
+
+
+class Inotify(object):
+
+    """Watch for the entries being created in a directory."""
+
+    def __init__(self, directory):
+        """Start watching the directory.
+
+        :raise OSError: when inotify is not available or the directory can not be watched
+        """
+        if libc is None:
+            raise OSError('inotify is not supported on this platform')
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CREATE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, 'inotify_add_watch failed', directory)
+        self.fd = fd
+
+    def wait(self, timeout):
+        """Wait for the entries to be created in the directory.
+
+        :return: whether some entries were created
+        """
+        ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if ready:
+            try:
+                os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                pass
+        return bool(ready)
+
+    def close(self):
+        """Stop watching the directory."""
+        os.close(self.fd)
+
+
+class Checker(abc.ABC):
+
+    """Base of the checkers, waiting by polling."""
+
+    poll_schedule = (0.005, 2, 0.1)
+
+    @abc.abstractmethod
+    def __call__(self):
+        """Check whether the service is ready."""
+
+    def wait(self, timeout):
+        """Wait for the check to succeed.
+
+        :param timeout: number of seconds to wait
+        :return: whether the check succeeded
+        """
+        return self.poll(time.monotonic() + timeout)
+
+    def poll(self, deadline):
+        """Poll until the check succeeds or the deadline is reached."""
+        for delay in poll_delays(self.poll_schedule):
+            if self():
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+
+
+def wait_for_path(checker, path, timeout):
+    """Wait for the path to be created and the check to succeed.
+
+    Waiting for the path is driven by inotify, with a fallback to polling.
+
+    :param checker: the checker
+    :param path: the path created by the service, eg. its unix socket
+    :param timeout: number of seconds to wait
+    :return: whether the check succeeded
+    """
+    if checker():
+        return True
+    deadline = time.monotonic() + timeout
+    if not os.path.exists(path):
+        try:
+            watch = Inotify(os.path.dirname(path) or os.curdir)
+        except OSError:
+            return checker.poll(deadline)
+
+        with contextlib.closing(watch):
+            # The path is checked after the watch is added, so its creation can't be missed.
+            while not os.path.exists(path):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                watch.wait(remaining)
+    # The path exists, but the service may not be ready to accept the connections yet.
+    return checker.poll(deadline)
+
+
+class PathExists(Checker):
+
+    """Check that the path (eg. socket or pid file of the service) exists.
+
+    Waiting is driven by inotify, with a fallback to polling.
+    """
+
+    def __init__(self, path):
+        """Assign the path."""
+        self.path = path
+
+    def __call__(self):
+        """Check whether the path exists."""
+        return os.path.exists(self.path)
+
+    def wait(self, timeout):
+        """Wait for the path to be created, see `wait_for_path`."""
+        return wait_for_path(self, self.path, timeout)
+
+
+class DisplayFD(Checker):
+
+    """Check that the X server wrote its display number to the `-displayfd` pipe.
+
+    The X server writes the display number followed by a newline when it is ready to accept the connections,
+    so the waiting blocks on the pipe instead of polling. The display number is assigned to the `display`
+    attribute.
+    """
+
+    def __init__(self, fd):
+        """Assign the read end of the pipe."""
+        self.fd = fd
+        self.data = b''
+        self.display = None
+
+    def __call__(self):
+        """Check whether the display number was written."""
+        return self.wait(0)
+
+    def wait(self, timeout):
+        """Wait for the display number to be written.
+
+        :param timeout: number of seconds to wait
+        :return: whether the display number was written
+        """
+        deadline = time.monotonic() + timeout
+        while self.display is None:
+            ready, _, _ = select.select([self.fd], [], [], max(deadline - time.monotonic(), 0))
+            if not ready:
+                return False
+            chunk = os.read(self.fd, 64)
+            if not chunk:
+                return False
+            self.data += chunk
+            if b'\n' in self.data:
+                self.display = int(self.data.split(b'\n')[0])
+        return True
+
+
+def recv_exactly(sock, size):
+    """Receive exactly the given number of bytes from the socket."""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ValueError('connection closed')
+        data += chunk
+    return data
+
+
+class SocketConnect(Checker):
+
+    """Check that the service accepts the connections.
+
+    The address is either the unix socket path or a tuple in form `(host, port)`. Every check opens a new
+    connection, which is closed afterwards, and is bounded by the timeout. The unix socket is waited for by the
+    inotify, see `wait_for_path`.
+    """
+
+    def __init__(self, address, timeout=0.25):
+        """Assign the address and the timeout of a single check."""
+        self.address = address
+        self.timeout = timeout
+
+    def __call__(self):
+        """Check the service."""
+        try:
+            with contextlib.closing(self.connect()) as sock:
+                return self.probe(sock)
+        except (OSError, ValueError):
+            return False
+
+    def wait(self, timeout):
+        """Wait for the check to succeed."""
+        if isinstance(self.address, str):
+            return wait_for_path(self, self.address, timeout)
+        return super(SocketConnect, self).wait(timeout)
+
+    def connect(self):
+        """Connect to the service."""
+        if not isinstance(self.address, str):
+            return socket.create_connection(self.address, self.timeout)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def probe(self, sock):
+        """Check the connected service, the connection is enough by default."""
+        return True
+
+
+class TCPConnect(SocketConnect):
+
+    """Check that the service accepts the TCP connections."""
+
+    def __init__(self, host, port, timeout=0.25):
+        """Assign the address and the timeout of a single check."""
+        super(TCPConnect, self).__init__((host, port), timeout)
+
+
+class UnixSocketConnect(SocketConnect):
+
+    """Check that the service accepts the connections on the unix socket."""
+
+
+class MemcachedVersion(SocketConnect):
+
+    """Check that memcached responds to the `version` command."""
+
+    def probe(self, sock):
+        """Send the `version` command."""
+        sock.sendall(b'version\r\n')
+        response = b''
+        while not response.endswith(b'\r\n'):
+            chunk = sock.recv(1024)
+            if not chunk:
+                return False
+            response += chunk
+        return response.startswith(b'VERSION ')
+
+
+class MySQLHandshake(SocketConnect):
+
+    """Check that mysqld sends the initial handshake packet."""
+
+    def probe(self, sock):
+        """Read the handshake packet, protocol version 10 is sent by the server ready to accept the clients."""
+        header = recv_exactly(sock, 4)
+        payload = recv_exactly(sock, int.from_bytes(header[:3], 'little'))
+        return payload[:1] == b'\x0a'
+
+
+class HTTPGet(Checker):
+
+    """Check that the HTTP service responds to the GET request with a successful status."""
+
+    def __init__(self, url, timeout=0.25):
+        """Assign the url and the timeout of a single check."""
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self):
+        """Send the GET request."""
+        url = urllib.parse.urlsplit(self.url)
+        connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        connection = connection_class(url.netloc, timeout=self.timeout)
+        try:
+            connection.request('GET', urllib.parse.urlunsplit(('', '', url.path or '/', url.query, '')))
+            return connection.getresponse().status < 400
+        except (OSError, http.client.HTTPException):
+            return False
+        finally:
+            connection.close()
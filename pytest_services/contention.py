@@ -0,0 +1,122 @@
+"""Contention metrics of the inter-process locks."""
+import bisect
+import os
+import threading
+
+import pytest
+
+contention_key = pytest.StashKey()
+
+# The contention metrics of the test session, None if the plugin is not configured.
+stats = None
+
+# Upper bounds of the wait histogram buckets in seconds, the last bucket is unbounded.
+wait_buckets = (0.001, 0.01, 0.1, 1)
+
+
+class LockContention(object):
+
+    """Contention metrics of the locks used by the worker.
+
+    Every record is a dict with the following keys:
+
+    * worker: id of the worker which used the lock
+    * kind: `file_lock` or `lock_resource`
+    * lock: name of the lock file, eg. `port` or `xvfb_100.lock`
+    * acquisitions: number of the times the lock was acquired
+    * retries: number of the failed attempts to acquire the lock
+    * timeouts: number of the times the lock was not acquired in time
+    * slept: number of seconds spent sleeping between the attempts
+    * max_wait: maximum number of seconds it took to acquire the lock
+    * waits: histogram of the waits, see `wait_buckets`
+    """
+
+    def __init__(self, worker='local'):
+        """Initialize the records."""
+        self.worker = worker
+        self.records = []
+        self.index = {}
+        self.lock = threading.Lock()
+
+    def record(self, kind, path, wait, retries, slept, acquired=True):
+        """Record the attempt to acquire the lock.
+
+        :param kind: `file_lock` or `lock_resource`
+        :param path: path of the lock file
+        :param wait: number of seconds since the first attempt
+        :param retries: number of the failed attempts
+        :param slept: number of seconds spent sleeping between the attempts
+        :param acquired: whether the lock was acquired or the attempts timed out
+        """
+        lock = os.path.basename(path)
+        with self.lock:
+            record = self.index.get((kind, lock))
+            if record is None:
+                record = self.index[(kind, lock)] = dict(
+                    worker=self.worker, kind=kind, lock=lock, acquisitions=0, retries=0, timeouts=0,
+                    slept=0.0, max_wait=0.0, waits=[0] * (len(wait_buckets) + 1),
+                )
+                self.records.append(record)
+            if acquired:
+                record['acquisitions'] += 1
+            else:
+                record['timeouts'] += 1
+            record['retries'] += retries
+            record['slept'] += slept
+            record['max_wait'] = max(record['max_wait'], wait)
+            record['waits'][bisect.bisect_left(wait_buckets, wait)] += 1
+
+
+def record(kind, path, wait, retries, slept, acquired=True):
+    """Record the attempt to acquire the lock if the metrics are collected, see `LockContention.record`."""
+    if stats is not None:
+        stats.record(kind, path, wait, retries, slept, acquired)
+
+
+def get_contention(config):
+    """The lock contention metrics of the test session."""
+    return config.stash[contention_key]
+
+
+def aggregate(records):
+    """Sum up the records of all the workers per lock.
+
+    :param records: list of the records of the workers
+    :return: list of the records with the worker `*`
+    """
+    totals = {}
+    for record in records:
+        key = (record['kind'], record['lock'])
+        if key not in totals:
+            totals[key] = dict(record, worker='*', waits=list(record['waits']))
+            continue
+        total = totals[key]
+        for field in ('acquisitions', 'retries', 'timeouts', 'slept'):
+            total[field] += record[field]
+        total['max_wait'] = max(total['max_wait'], record['max_wait'])
+        total['waits'] = [a + b for a, b in zip(total['waits'], record['waits'])]
+    return [totals[key] for key in sorted(totals)]
+
+
+def summary(records):
+    """Lines of the summary table of the records per worker, followed by the totals if there are several workers."""
+    rows = sorted(records, key=lambda record: (record['worker'], record['kind'], record['lock']))
+    if len({record['worker'] for record in records}) > 1:
+        rows += aggregate(records)
+    header = '/'.join(['<{0}s'.format(bound) for bound in wait_buckets] + ['more'])
+    rows = [('worker', 'kind', 'lock', 'acquired', 'retries', 'timeouts', 'slept', 'max wait', header)] + [
+        (
+            record['worker'],
+            record['kind'],
+            record['lock'],
+            str(record['acquisitions']),
+            str(record['retries']),
+            str(record['timeouts']),
+            '{0:.3f}s'.format(record['slept']),
+            '{0:.3f}s'.format(record['max_wait']),
+            '/'.join(str(count) for count in record['waits']),
+        )
+        for record in rows
+    ]
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    return ['  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows]
@@ -5,6 +5,8 @@ import shutil
 import psutil
 import pytest
 
+from . import trace
+
 
 @pytest.fixture(scope='session')
 def root_dir():
@@ -13,7 +15,7 @@ def root_dir():
 
 
 @pytest.yield_fixture(scope='session')
-def base_dir(request, session_id, root_dir, services_log):
+def base_dir(request, session_id, root_dir, services_log, services_timings):
     """The directory where test run artifacts should be stored.
 
     It is responsibility of fixtures and tests that depend on it to clean up
@@ -22,38 +24,46 @@ def base_dir(request, session_id, root_dir, services_log):
     """
     path = os.path.join(root_dir, 'sr-{0}'.format(session_id))
     services_log.debug('creating base dir: {0}'.format(path))
+    timing = services_timings.start('directory', 'base_dir')
     if not os.path.exists(path):
         os.mkdir(path)
 
     yield path
 
     services_log.debug('finalizing base dir: {0}'.format(path))
-    shutil.rmtree(path, ignore_errors=True)
+    with services_timings.measure(timing, 'teardown'), trace.span('rmtree', 'directory', path=path):
+        shutil.rmtree(path, ignore_errors=True)
 
 
 @pytest.fixture(scope='session')
-def temp_dir(request, base_dir, services_log):
+def temp_dir(request, base_dir, services_log, services_timings):
     """The temporary dir."""
     path = os.path.join(base_dir, 'tmp')
 
     services_log.debug('creating temp dir: {0}'.format(path))
+    services_timings.start('directory', 'temp_dir')
     if not os.path.exists(path):
         os.mkdir(path)
 
     return path
 
 
-@pytest.fixture(scope='session')
-def memory_root_dir(root_dir):
-    """The parent directory of the test artifact directory in memory."""
+def get_memory_root_dir(root_dir):
+    """The memory directory if there is enough free space in it, the root dir otherwise."""
     # check for a free space for at least 8 parallel processes
     if os.path.exists('/dev/shm') and psutil.disk_usage('/dev/shm').free > 1024 * 1024 * 64 * 10:
         return '/dev/shm'
     return root_dir
 
 
+@pytest.fixture(scope='session')
+def memory_root_dir(root_dir):
+    """The parent directory of the test artifact directory in memory."""
+    return get_memory_root_dir(root_dir)
+
+
 @pytest.yield_fixture(scope='session')
-def memory_base_dir(request, session_id, memory_root_dir, services_log):
+def memory_base_dir(request, session_id, memory_root_dir, services_log, services_timings):
     """The directory where memory test run artifacts should be stored.
 
     It is responsibility of fixtures and tests that depend on it to clean up
@@ -63,32 +73,41 @@ def memory_base_dir(request, session_id, memory_root_dir, services_log):
     path = os.path.join(memory_root_dir, 'sr-{0}'.format(session_id))
 
     services_log.debug('creating memory base dir: {0}'.format(path))
+    timing = services_timings.start('directory', 'memory_base_dir')
     if not os.path.exists(path):
         os.mkdir(path)
 
     yield path
 
     services_log.debug('finalizing memory base dir: {0}'.format(path))
-    shutil.rmtree(path, ignore_errors=True)
+    with services_timings.measure(timing, 'teardown'), trace.span('rmtree', 'directory', path=path):
+        shutil.rmtree(path, ignore_errors=True)
 
 
 @pytest.fixture(scope='session')
-def memory_temp_dir(request, memory_base_dir, services_log):
+def memory_temp_dir(request, memory_base_dir, services_log, services_timings):
     """The memory temporary dir."""
     path = os.path.join(memory_base_dir, 'tmp')
 
     services_log.debug('creating memory temp dir: {0}'.format(path))
+    services_timings.start('directory', 'memory_temp_dir')
     if not os.path.exists(path):
         os.mkdir(path)
 
     return path
 
 
+def get_lock_dir(memory_root_dir):
+    """The lock dir in the memory root dir."""
+    return os.path.join(memory_root_dir, 'service-locks')
+
+
 @pytest.fixture(scope='session')
-def lock_dir(memory_root_dir, services_log):
+def lock_dir(memory_root_dir, services_log, services_timings):
     """The lock dir."""
-    path = os.path.join(memory_root_dir, 'service-locks')
+    path = get_lock_dir(memory_root_dir)
     services_log.debug('ensuring lock dir: {0}'.format(path))
+    services_timings.start('directory', 'lock_dir')
     if not os.path.exists(path):
         try:
             os.mkdir(path, 0o777)
@@ -105,10 +124,11 @@ def lock_dir(memory_root_dir, services_log):
 
 
 @pytest.fixture(scope='session')
-def run_dir(memory_temp_dir, services_log):
+def run_dir(memory_temp_dir, services_log, services_timings):
     """The run dir (like local /var/run)."""
     path = os.path.join(memory_temp_dir, 'run')
     services_log.debug('creating run dir: {0}'.format(path))
+    services_timings.start('directory', 'run_dir')
     os.mkdir(path)
 
     return path
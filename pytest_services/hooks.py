@@ -0,0 +1,11 @@
+"""Hook specifications of the services plugin."""
+
+
+def pytest_services_lock_contention(config, records):
+    """Called at the end of the test session with the lock contention metrics.
+
+    Called once, by the xdist controller or the single process, with the records of all the workers.
+
+    :param config: pytest config object
+    :param records: list of the `pytest_services.contention.LockContention` records
+    """
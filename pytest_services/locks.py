@@ -4,13 +4,24 @@ import json
 import os
 from random import random
 import socket
+import threading
 import time
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
+import psutil
 import pytest
 import zc.lockfile
 
+from . import contention, trace
+
 marker = object()
 
+# Suffix of the file with the owners of the resources in the shared resource list, see `locked_resources`.
+OWNERS_SUFFIX = '.owners'
+
 
 def try_remove(filename):
     try:
@@ -19,27 +30,143 @@ def try_remove(filename):
         pass
 
 
-@contextlib.contextmanager
-def file_lock(filename, remove=True, timeout=20):
-    """A lock that is shared across processes.
+class BlockingLockFile(object):
 
-    :param filename: the name of the file that will be locked.
-    :param remove: whether or not to remove the file on context close
-    :param timeout: Amount of time to retry the file lock if a :class:`zc.lockfile.LockError` is hit
+    """Exclusive or shared lock of the file, blocking in the kernel until the lock is released by its holder.
+
+    The lock is the `flock` used by :class:`zc.lockfile.SimpleLockFile`, so both exclude each other. The blocking
+    `flock` is run in a thread, which is abandoned when the timeout expires and releases the lock as soon as it
+    gets it. A lock of the file which was removed by its previous holder while waiting is not valid, so the lock
+    is acquired again.
     """
+
+    def __init__(self, path, timeout, shared=False):
+        """Acquire the lock.
+
+        :param path: path of the lock file
+        :param timeout: number of seconds to wait for the lock
+        :param shared: whether the lock is shared with the other shared locks of the file
+        :raise zc.lockfile.LockError: when the lock was not acquired in time
+        """
+        self._path = path
+        self._operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        self._fp = None
+        start = time.monotonic()
+        blocked = 0
+        deadline = start + timeout
+        while self._fp is None:
+            fp = self.open()
+            try:
+                fcntl.flock(fp.fileno(), self._operation | fcntl.LOCK_NB)
+            except OSError:
+                blocked += 1
+                if not self.wait(fp, deadline, self._operation):
+                    contention.record(
+                        'file_lock', path, time.monotonic() - start, blocked, time.monotonic() - start,
+                        acquired=False)
+                    raise zc.lockfile.LockError("Couldn't lock {0!r}".format(path))
+            if self.current(fp):
+                self._fp = fp
+            else:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+                fp.close()
+        waited = time.monotonic() - start
+        contention.record('file_lock', path, waited, blocked, waited if blocked else 0)
+
+    def open(self):
+        """Open the lock file for writing without truncation."""
+        try:
+            return open(self._path, 'r+')
+        except IOError:
+            return open(self._path, 'a+')
+
+    def current(self, fp):
+        """Check whether the locked file is still the one at the path."""
+        try:
+            return os.path.samestat(os.fstat(fp.fileno()), os.stat(self._path))
+        except OSError:
+            return False
+
+    @staticmethod
+    def wait(fp, deadline, operation):
+        """Wait for the `flock` operation on the file until the deadline.
+
+        :return: whether the lock was acquired, the file is closed otherwise
+        """
+        state = dict(acquired=False, finished=False, cancelled=False)
+        state_lock = threading.Lock()
+        done = threading.Event()
+
+        def acquire():
+            try:
+                fcntl.flock(fp.fileno(), operation)
+                acquired = True
+            except OSError:
+                acquired = False
+            with state_lock:
+                state['acquired'], state['finished'] = acquired, True
+                if state['cancelled']:
+                    # the waiter gave up, release the lock as soon as it's acquired
+                    acquired and fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+                    fp.close()
+            done.set()
+
+        threading.Thread(target=acquire, name='file_lock {0}'.format(fp.name), daemon=True).start()
+        done.wait(max(deadline - time.monotonic(), 0))
+        with state_lock:
+            if state['acquired']:
+                return True
+            if state['finished']:
+                fp.close()
+            else:
+                state['cancelled'] = True
+            return False
+
+    def close(self):
+        """Release the lock."""
+        if self._fp is not None:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+            self._fp.close()
+            self._fp = None
+
+
+def poll_lock_file(filename, timeout):
+    """Acquire the :class:`zc.lockfile.SimpleLockFile` by polling, where the blocking lock is not supported."""
     total_seconds_slept = 0
+    retries = 0
+    start = time.monotonic()
     while True:
         try:
-            with contextlib.closing(zc.lockfile.SimpleLockFile(filename)) as lockfile:
-                yield lockfile._fp
-                break
+            lockfile = zc.lockfile.SimpleLockFile(filename)
+            contention.record('file_lock', filename, time.monotonic() - start, retries, total_seconds_slept)
+            return lockfile
         except zc.lockfile.LockError as err:
             if total_seconds_slept >= timeout:
+                contention.record(
+                    'file_lock', filename, time.monotonic() - start, retries, total_seconds_slept, acquired=False)
                 raise err
         seconds_to_sleep = random() * 0.1 + 0.05
         total_seconds_slept += seconds_to_sleep
+        retries += 1
         time.sleep(seconds_to_sleep)
 
+
+@contextlib.contextmanager
+def file_lock(filename, remove=True, timeout=20, shared=False):
+    """A lock that is shared across processes.
+
+    The lock is waited for in the kernel, see :class:`BlockingLockFile`.
+
+    :param filename: the name of the file that will be locked.
+    :param remove: whether or not to remove the file on context close, the file of the shared lock must be kept
+    :param timeout: Amount of time to wait for the lock before :class:`zc.lockfile.LockError` is raised
+    :param shared: whether the lock is shared with the other shared locks of the file and excludes only the
+        exclusive locks, the lock is exclusive without the `fcntl`
+    """
+    lockfile = poll_lock_file(filename, timeout) if fcntl is None else BlockingLockFile(filename, timeout, shared)
+    with contextlib.closing(lockfile):
+        yield lockfile._fp
+
     remove and try_remove(filename)
 
 
@@ -50,23 +177,139 @@ def unlock_resource(name, resource, lock_dir, services_log):
     :param resource: resource value which was previously locked
     :param lock_dir: directory for lockfiles to use.
     """
-    with locked_resources(name, lock_dir) as bound_resources:
+    unlock_resources(name, [resource], lock_dir, services_log)
+
+
+def unlock_resources(name, resources, lock_dir, services_log):
+    """Unlock previously locked resources at once.
+
+    :param name: name to be used to separate various resources, eg. port, display
+    :param resources: list of the resource values which were previously locked
+    :param lock_dir: directory for lockfiles to use.
+    """
+    with locked_resources(name, lock_dir) as registry:
+        for resource in resources:
+            entries = [entry for entry in registry if resource_value(entry) == resource]
+            # prefer the entry of this process, in case the resource was reclaimed from a dead owner
+            entries.sort(key=lambda entry: not (isinstance(entry, dict) and entry.get('pid') == os.getpid()))
+            if entries:
+                registry.remove(entries[0])
+            services_log.debug('resource freed {0}: {1}'.format(name, resource))
+        services_log.debug('bound resources {0}: {1}'.format(name, registry))
+
+
+def resource_value(entry):
+    """The resource of the registry entry, legacy entries are bare resources."""
+    return entry['resource'] if isinstance(entry, dict) else entry
+
+
+def owner_entry(resource, session_id=None):
+    """The registry entry of the resource owned by the current process."""
+    return dict(
+        resource=resource,
+        pid=os.getpid(),
+        started=psutil.Process().create_time(),
+        session=session_id,
+    )
+
+
+def owner_alive(entry):
+    """Check whether the owner process of the registry entry is still running."""
+    try:
+        process = psutil.Process(entry['pid'])
+        return process.create_time() == entry['started'] and process.status() != psutil.STATUS_ZOMBIE
+    except (psutil.Error, KeyError):
+        return False
+
+
+def sweep_resources(registry, legacy=False):
+    """Remove the entries of the dead owners from the registry.
+
+    :param registry: list of the registry entries, modified in place
+    :param legacy: whether to remove the legacy entries without the owner as well
+    :return: list of the removed entries
+    """
+    stale = [
+        entry for entry in registry
+        if (not owner_alive(entry) if isinstance(entry, dict) else legacy)
+    ]
+    for entry in stale:
+        registry.remove(entry)
+    return stale
+
+
+def is_registry(value):
+    """Check whether the value is a list of the resource registry entries."""
+    return isinstance(value, list) and bool(value) and all(
+        isinstance(entry, int) or (isinstance(entry, dict) and 'resource' in entry) for entry in value)
+
+
+def gc_locks(lock_dir, services_log):
+    """Compact the resource registries in the lock dir, removing the entries of the dead and legacy owners.
+
+    :return: dict of the resource names and the removed entries
+    """
+    removed = {}
+    for name in sorted(os.listdir(lock_dir)):
+        if name.endswith(OWNERS_SUFFIX):
+            continue
         try:
-            bound_resources.remove(resource)
-        except ValueError:
-            pass
-        services_log.debug('resource freed {0}: {1}'.format(name, resource))
-        services_log.debug('bound resources {0}: {1}'.format(name, bound_resources))
+            with open(os.path.join(lock_dir, name)) as fd:
+                if not is_registry(json.loads(fd.read())):
+                    continue
+        except (IOError, ValueError):
+            continue
+        with locked_resources(name, lock_dir) as registry:
+            if is_registry(registry):
+                removed[name] = sweep_resources(registry, legacy=True)
+                services_log.debug('resources reclaimed {0}: {1}'.format(name, removed[name]))
+    return removed
+
+
+def attach_owners(resources, owners):
+    """The registry entries of the bare resources, with the owners recorded for them.
+
+    The resources bound by the older releases have no owner, the owners of the resources which were released
+    by the older releases are dropped.
+    """
+    index = {}
+    for entry in owners:
+        if isinstance(entry, dict) and 'resource' in entry:
+            index.setdefault(json.dumps(entry['resource']), []).append(entry)
+    registry = []
+    for resource in resources:
+        if isinstance(resource, dict):
+            registry.append(resource)
+            continue
+        entries = index.get(json.dumps(resource))
+        registry.append(entries.pop(0) if entries else resource)
+    return registry
+
+
+def read_json_list(path):
+    """The list stored in the JSON file, empty if the file doesn't exist or is not a list."""
+    try:
+        with open(path) as fd:
+            value = json.loads(fd.read())
+    except (IOError, ValueError):
+        return []
+    return value if isinstance(value, list) else []
 
 
 @contextlib.contextmanager
-def locked_resources(name, lock_dir):
+def locked_resources(name, lock_dir, timeout=20):
     """Contextmanager providing an access to locked shared resource list.
 
+    The lock dir is shared with the older releases, which expect the list of the bare resources in the file.
+    The owners of the entries (see `owner_entry`) are kept in the `<name>.owners` file next to it, which is
+    written under the same lock.
+
     :param name: name to be used to separate various resources, eg. port, display
     :param lock_dir: directory for lockfiles to use.
+    :param timeout: Amount of time to retry the file lock
     """
-    with file_lock(os.path.join(lock_dir, name), remove=False) as fd:
+    owners_path = os.path.join(lock_dir, name + OWNERS_SUFFIX)
+    with file_lock(os.path.join(lock_dir, name), remove=False, timeout=timeout) as fd:
         bound_resources = fd.read().strip()
         if bound_resources:
             try:
@@ -75,12 +318,17 @@ def locked_resources(name, lock_dir):
                 bound_resources = None
         if not isinstance(bound_resources, list):
             bound_resources = []
+        bound_resources = attach_owners(bound_resources, read_json_list(owners_path))
         yield bound_resources
 
         fd.seek(0)
         fd.truncate()
-        fd.write(json.dumps(bound_resources))
+        fd.write(json.dumps([resource_value(entry) for entry in bound_resources]))
         fd.flush()
+        owners = [entry for entry in bound_resources if isinstance(entry, dict)]
+        if owners or os.path.exists(owners_path):
+            with open(owners_path, 'w') as owners_fd:
+                owners_fd.write(json.dumps(owners))
 
 
 def unlock_port(port, lock_dir, services_log):
@@ -99,49 +347,162 @@ def lock_resource_timeout():
     return 20
 
 
-def lock_resource(name, resource_getter, lock_dir, services_log, lock_resource_timeout):
-    """Issue a lock for given resource."""
-    total_seconds_slept = 0
-    while True:
-        try:
-            with locked_resources(name, lock_dir) as bound_resources:
-                services_log.debug('bound_resources {0}: {1}'.format(name, bound_resources))
-                resource = resource_getter(bound_resources)
-                while resource in bound_resources:
-                    # resource is already taken by someone, retry
-                    services_log.debug('bound resources {0}: {1}'.format(name, bound_resources))
-                    resource = resource_getter(bound_resources)
-                services_log.debug('free resource choosen {0}: {1}'.format(name, resource))
-                bound_resources.append(resource)
-                services_log.debug('bound resources {0}: {1}'.format(name, bound_resources))
-                return resource
-        except zc.lockfile.LockError as err:
-            if total_seconds_slept >= lock_resource_timeout:
-                raise err
-            services_log.debug('lock resource failed: {0}'.format(err))
+def lock_resource(name, resource_getter, lock_dir, services_log, lock_resource_timeout, session_id=None):
+    """Issue a lock for given resource.
 
-        seconds_to_sleep = random() * 0.1 + 0.05
-        total_seconds_slept += seconds_to_sleep
-        time.sleep(seconds_to_sleep)
+    The resource is registered with its owner process and session, the resources of the owners which are
+    not running anymore are reclaimed.
+
+    :param resource_getter: function getting the free resource from the list of the bound ones
+    """
+    def resources_getter(bound_resources):
+        return [resource_getter(bound_resources)]
 
+    return lock_resources(
+        name, resources_getter, lock_dir, services_log, lock_resource_timeout, session_id)[0]
 
-def get_free_port(lock_dir, services_log, lock_resource_timeout):
-    """Get free port to listen on."""
-    def get_port(bound_resources):
-        if bound_resources:
-            port = max(bound_resources) + 1
-        else:
-            port = 30000
 
+def lock_resources(name, resources_getter, lock_dir, services_log, lock_resource_timeout, session_id=None):
+    """Issue a lock for several resources at once, in a single critical section.
+
+    :param resources_getter: function getting the list of the free resources from the list of the bound ones
+    :return: list of the locked resources
+    """
+    total_seconds_slept = 0
+    start = time.monotonic()
+    deadline = start + lock_resource_timeout
+    with trace.span('lock_resource', 'lock', name=name, retries=0) as span_args:
         while True:
-            s = socket.socket()
             try:
-                s.bind(('127.0.0.1', port))
-                s.close()
-                return port
-            except socket.error:
+                with locked_resources(name, lock_dir, timeout=max(deadline - time.monotonic(), 0)) as registry:
+                    contention.record(
+                        'lock_resource', name, time.monotonic() - start, span_args['retries'], total_seconds_slept)
+                    stale = sweep_resources(registry)
+                    if stale:
+                        services_log.debug('resources reclaimed {0}: {1}'.format(name, stale))
+                    bound_resources = [resource_value(entry) for entry in registry]
+                    services_log.debug('bound_resources {0}: {1}'.format(name, bound_resources))
+                    resources = resources_getter(bound_resources)
+                    while any(resource in bound_resources for resource in resources):
+                        # resource is already taken by someone, retry
+                        services_log.debug('bound resources {0}: {1}'.format(name, bound_resources))
+                        resources = resources_getter(bound_resources)
+                    services_log.debug('free resources choosen {0}: {1}'.format(name, resources))
+                    bound_resources.extend(resources)
+                    registry.extend(owner_entry(resource, session_id) for resource in resources)
+                    services_log.debug('bound resources {0}: {1}'.format(name, bound_resources))
+                    span_args['resource'] = resources[0] if len(resources) == 1 else resources
+                    return resources
+            except zc.lockfile.LockError as err:
+                if time.monotonic() >= deadline:
+                    contention.record(
+                        'lock_resource', name, time.monotonic() - start, span_args['retries'], total_seconds_slept,
+                        acquired=False)
+                    raise err
+                services_log.debug('lock resource failed: {0}'.format(err))
+
+            seconds_to_sleep = random() * 0.1 + 0.05
+            total_seconds_slept += seconds_to_sleep
+            span_args['retries'] += 1
+            time.sleep(seconds_to_sleep)
+
+
+def port_free(port):
+    """Check whether the port can be bound."""
+    s = socket.socket()
+    try:
+        s.bind(('127.0.0.1', port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+
+def used_ports():
+    """Local ports of the TCP sockets in the kernel tables, read at once.
+
+    Empty where `/proc/net/tcp` is not available.
+    """
+    ports = set()
+    for path in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(path) as fd:
+                lines = fd.readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            try:
+                ports.add(int(line.split()[1].rsplit(':', 1)[1], 16))
+            except (IndexError, ValueError):
                 pass
-            port += 1
+    return ports
+
+
+def free_port_checker():
+    """Function checking whether the port is free.
+
+    The ports used by the TCP sockets in the kernel tables are skipped without binding them, the other ports
+    are checked by `port_free`.
+    """
+    used = used_ports()
+
+    def is_free(port):
+        return port not in used and port_free(port)
+    return is_free
+
+
+def display_free(display):
+    """Check whether the display is not used by an X server."""
+    return not os.path.exists('/tmp/.X{0}-lock'.format(display))
+
+
+def parse_port_range(value):
+    """Parse the port range in form `first-last` to the tuple of the first port and the port after the last one."""
+    first, last = value.split('-')
+    return int(first), int(last) + 1
+
+
+def next_free_resource(bound_resources, start, is_free, end=None):
+    """Get the lowest free resource which is not bound.
+
+    :param bound_resources: list of the bound resources
+    :param start: the lowest resource
+    :param is_free: function checking whether the resource is not used by someone else
+    :param end: the resource after the highest one, unbounded by default
+    """
+    return next_free_resources(bound_resources, start, is_free, 1, end=end)[0]
+
+
+def next_free_resources(bound_resources, start, is_free, count, contiguous=False, end=None):
+    """Get the lowest free resources which are not bound, so the released resources are reused first.
+
+    :param bound_resources: list of the bound resources
+    :param start: the lowest resource
+    :param is_free: function checking whether the resource is not used by someone else
+    :param count: number of the resources
+    :param contiguous: whether the resources have to form a contiguous block
+    :param end: the resource after the highest one, unbounded by default
+    :raise Exception: when there are not enough free resources below the end
+    """
+    bound_resources = set(bound_resources)
+    resources = []
+    resource = start
+    while len(resources) < count:
+        if end is not None and resource >= end:
+            raise Exception('There are no {0} free resources in the range {1}-{2}.'.format(count, start, end - 1))
+        if resource not in bound_resources and is_free(resource):
+            resources.append(resource)
+        elif contiguous:
+            resources = []
+        resource += 1
+    return resources
+
+
+def get_free_port(lock_dir, services_log, lock_resource_timeout, port_range=(30000, 32768)):
+    """Get free port to listen on."""
+    def get_port(bound_resources):
+        return next_free_resource(bound_resources, port_range[0], free_port_checker(), port_range[1])
 
     return lock_resource('port', get_port, lock_dir, services_log, lock_resource_timeout)
 
@@ -149,38 +510,94 @@ def get_free_port(lock_dir, services_log, lock_resource_timeout):
 def get_free_display(lock_dir, services_log, lock_resource_timeout):
     """Get free display to listen on."""
     def get_display(bound_resources):
-        display = 100
-        while True:
-            if bound_resources:
-                display = max(bound_resources) + 1
-            if os.path.exists('/tmp/.X{0}-lock'.format(display)):
-                display += 1
-                continue
-            return display
+        return next_free_resource(bound_resources, 100, display_free)
 
     return lock_resource('display', get_display, lock_dir, services_log, lock_resource_timeout)
 
 
 @pytest.fixture(scope='session')
-def port_getter(request, lock_dir, services_log, lock_resource_timeout):
+def port_range(request):
+    """The range of the ports allocated by the `port_getter`, see `--services-port-range`.
+
+    Tuple of the first port and the port after the last one.
+    """
+    return parse_port_range(request.config.option.services_port_range)
+
+
+@pytest.fixture(scope='session')
+def port_getter(request, resource_allocator, port_range):
     """Lock getter function."""
-    def get_port():
-        """Lock a free port and unlock it on finalizer."""
-        port = get_free_port(lock_dir, services_log, lock_resource_timeout)
+    def get_port(count=None, contiguous=False):
+        """Lock a free port and unlock it on finalizer.
+
+        :param count: number of the ports to lock at once, the list of the ports is returned if given
+        :param contiguous: whether the ports have to form a contiguous block
+        """
+        first, end = port_range
+        if count is None:
+            ports = [resource_allocator.allocate('port', first, free_port_checker(), end)]
+        else:
+            ports = resource_allocator.allocate_many('port', first, free_port_checker(), count, contiguous, end)
 
         def finalize():
-            unlock_port(port, lock_dir, services_log)
+            resource_allocator.release('port', *ports)
         request.addfinalizer(finalize)
-        return port
+        return ports[0] if count is None else ports
     return get_port
 
 
 @pytest.fixture(scope='session')
-def display_getter(request, lock_dir, services_log, lock_resource_timeout):
+def socket_getter(request, resource_allocator, port_range):
+    """Listening socket getter function."""
+    def get_socket(backlog=128):
+        """Lock a free port and bind the listening socket to it, close the socket and unlock the port on finalizer.
+
+        The socket is bound while the port is checked to be free, and is meant to be passed to the service by
+        the `sockets` argument of the `watcher_getter`, so no one can take the port before the service listens on
+        it. The port is `sock.getsockname()[1]`.
+        """
+        bound = []
+        used = used_ports()
+
+        def bind(port):
+            if port in used:
+                return False
+            sock = socket.socket()
+            try:
+                sock.bind(('127.0.0.1', port))
+            except socket.error:
+                sock.close()
+                return False
+            bound.append(sock)
+            return True
+
+        port = resource_allocator.allocate('port', port_range[0], bind, port_range[1])
+        sock = bound.pop()
+        for other in bound:
+            other.close()
+
+        def finalize():
+            sock.close()
+            resource_allocator.release('port', port)
+        request.addfinalizer(finalize)
+        sock.listen(backlog)
+        return sock
+    return get_socket
+
+
+@pytest.fixture(scope='session')
+def display_getter(request, resource_allocator):
     """Display getter function."""
-    def get_display():
-        """Lock a free display and unlock it on finalizer."""
-        display = get_free_display(lock_dir, services_log, lock_resource_timeout)
-        request.addfinalizer(lambda: unlock_display(display, lock_dir, services_log))
-        return display
+    def get_display(count=None, contiguous=False):
+        """Lock a free display and unlock it on finalizer.
+
+        :param count: number of the displays to lock at once, the list of the displays is returned if given
+        :param contiguous: whether the displays have to form a contiguous block
+        """
+        if count is None:
+            displays = [resource_allocator.allocate('display', 100, display_free)]
+        else:
+            displays = resource_allocator.allocate_many('display', 100, display_free, count, contiguous)
+        request.addfinalizer(lambda: resource_allocator.release('display', *displays))
+        return displays[0] if count is None else displays
     return get_display
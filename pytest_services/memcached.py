@@ -2,6 +2,9 @@
 import os
 import pytest
 
+from .checkers import MemcachedVersion
+from .probes import version
+
 
 @pytest.fixture(scope='session')
 def memcached_socket(run_dir, run_services):
@@ -17,11 +20,17 @@ def memcached(request, run_services, memcached_socket, watcher_getter):
         return watcher_getter(
             name='memcached',
             arguments=['-s', memcached_socket],
-            checker=lambda: os.path.exists(memcached_socket),
+            checker=MemcachedVersion(memcached_socket),
             request=request,
         )
 
 
+@pytest.fixture(scope='session')
+def memcached_version(services_probes):
+    """The version of memcached, eg. `memcached 1.6.21`."""
+    return services_probes.probe('memcached', 'version', lambda executable: version(executable, '-V'))
+
+
 @pytest.fixture(scope='session')
 def memcached_connection(run_services, memcached_socket):
     """The connection string to the local memcached instance."""
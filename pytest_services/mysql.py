@@ -1,50 +1,266 @@
 """Fixtures for mysql."""
+import hashlib
 import os
 import shutil
+import tempfile
+import time
 from textwrap import dedent
 
-import pytest
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+try:
+    import subprocess32 as subprocess
+except ImportError:  # pragma: no cover
+    import subprocess
 
+import psutil
+import pytest
+import zc.lockfile
+
+from . import trace
+from .checkers import MySQLHandshake
+from .locks import (
+    file_lock,
+    locked_resources,
+    owner_entry,
+    sweep_resources,
+    try_remove,
+)
+from .probes import version, which
 from .process import (
     CalledProcessWithOutputError,
     check_output,
 )
+from .service import wait_for_service
+
+
+def write_mysql_defaults_file(path, tmpdir):
+    """Write the MySQL defaults file."""
+    with open(path, 'w+') as fd:
+        user = os.environ["USER"]
+        fd.write(
+            dedent(
+                f"""
+                [mysqld]
+                user = {user}
+                tmpdir = {tmpdir}
+                default-time-zone = SYSTEM
+                """
+            )
+        )
+
+
+@pytest.fixture(scope='session')
+def mysql_shared(request):
+    """Whether a single mysqld is shared by all the test sessions on the host."""
+    return request.config.option.mysql_shared
+
+
+@pytest.fixture(scope='session')
+def mysql_shared_dir(run_services, mysql_shared, memory_root_dir):
+    """The directory of the shared mysqld instance.
+
+    Created by the session starting the shared mysqld, see `shared_mysql_watcher`.
+    """
+    if run_services and mysql_shared:
+        return os.path.join(memory_root_dir, 'mysql-shared')
 
 
 @pytest.fixture(scope='session')
 def mysql_defaults_file(
-        run_services, tmp_path_factory, memory_temp_dir, request):
+        run_services, tmp_path_factory, memory_temp_dir, request, mysql_shared_dir):
     """MySQL defaults file."""
     if run_services:
+        if mysql_shared_dir:
+            # written by the session starting the shared mysqld
+            return os.path.join(mysql_shared_dir, 'defaults.cnf')
+
         cfg = tmp_path_factory.mktemp("pytest-services")
         defaults_path = str(cfg / 'defaults.cnf')
-
-        with open(defaults_path, 'w+') as fd:
-            user = os.environ["USER"]
-            fd.write(
-                dedent(
-                    f"""
-                    [mysqld]
-                    user = {user}
-                    tmpdir = {memory_temp_dir}
-                    default-time-zone = SYSTEM
-                    """
-                )
-            )
+        write_mysql_defaults_file(defaults_path, memory_temp_dir)
         return defaults_path
     return None
 
 
 @pytest.fixture(scope='session')
 def mysql_base_dir():
-    my_print_defaults = shutil.which('my_print_defaults')
+    my_print_defaults = which('my_print_defaults')
     assert my_print_defaults, 'You have to install my_print_defaults script.'
 
     return os.path.dirname(os.path.dirname(os.path.realpath(my_print_defaults)))
 
 
+@pytest.fixture(scope='session')
+def mysqld_version(services_probes):
+    """The version of mysqld, eg. `mysqld  Ver 8.0.36 for Linux on x86_64 (MySQL Community Server - GPL)`."""
+    return services_probes.probe('mysqld', 'version', version)
+
+
+# The ioctl cloning the file by the reflink (copy-on-write) on btrfs, xfs and the like.
+FICLONE = 0x40049409
+
+
+def clone_file(source, destination):
+    """Copy the file by the reflink if the filesystem supports it, by a regular copy otherwise."""
+    try:
+        if fcntl is None:
+            raise OSError('reflinks are not supported on this platform')
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        shutil.copyfile(source, destination)
+    shutil.copymode(source, destination)
+
+
+def clone_tree(source, destination):
+    """Copy the directory tree file by file with `clone_file`, the destination may exist."""
+    shutil.copytree(source, destination, symlinks=True, copy_function=clone_file, dirs_exist_ok=True)
+
+
+def normalized_mysql_defaults(mysql_defaults_file):
+    """The lines of the defaults file which affect the system database.
+
+    The comments, blank lines and the per session `tmpdir` are left out.
+    """
+    lines = []
+    with open(mysql_defaults_file) as fd:
+        for line in fd:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if line.split('=')[0].strip().replace('_', '-') == 'tmpdir':
+                continue
+            lines.append(line)
+    return lines
+
+
+def mysql_template_key(mysqld_version, mysql_defaults_file):
+    """Key of the system database template, a hash of the mysqld binary, its version and the defaults."""
+    mysqld = os.path.realpath(which('mysqld'))
+    stat = os.stat(mysqld)
+    key = hashlib.sha256()
+    for value in [mysqld, str(stat.st_mtime_ns), str(stat.st_size), mysqld_version] + normalized_mysql_defaults(
+            mysql_defaults_file):
+        key.update(value.encode('utf-8') + b'\n')
+    return key.hexdigest()[:16]
+
+
+# Number of seconds after which the unused template of the other key is removed, see `prune_mysql_templates`.
+MYSQL_TEMPLATE_MAX_AGE = 7 * 24 * 60 * 60
+
+
+def mysql_template_lock(lock_dir, key):
+    """The lock of the template, held exclusively while the template is initialized or removed.
+
+    The lock is shared while the template is cloned, so the sessions clone the template concurrently.
+    """
+    return os.path.join(lock_dir, 'mysql-template-{0}.lock'.format(key))
+
+
+def prune_mysql_templates(mysql_templates_dir, key, lock_dir, services_log, max_age=MYSQL_TEMPLATE_MAX_AGE):
+    """Remove the templates of the other keys which were not cloned for `max_age` seconds.
+
+    The templates of the other keys are used by the other mysqld binaries, defaults or users sharing the directory,
+    or they were left by the previous ones. The modification time of the template is updated when it's cloned,
+    see `clone_mysql_template`. The templates which are being cloned by the other sessions are skipped.
+    """
+    for name in os.listdir(mysql_templates_dir):
+        path = os.path.join(mysql_templates_dir, name)
+        # the templates being initialized have the pid suffix
+        if name == key or '.' in name or not os.path.isdir(path):
+            continue
+        try:
+            if time.time() - os.stat(path).st_mtime < max_age:
+                continue
+            with file_lock(mysql_template_lock(lock_dir, name), timeout=0):
+                services_log.debug('Removing mysql template {0}'.format(path))
+                shutil.rmtree(path, ignore_errors=True)
+        except (OSError, zc.lockfile.LockError):
+            pass
+
+
+def clone_mysql_template(
+        mysql_templates_dir, mysqld_version, mysql_data_dir, mysql_base_dir, mysql_defaults_file, lock_dir,
+        services_log, timeout=120):
+    """Clone the system database from the template, initialize the template first if it doesn't exist.
+
+    The template is initialized once per mysqld binary and defaults, by one of the concurrent sessions, and the
+    unused templates of the other keys are removed then, see `prune_mysql_templates`. The timezone tables are
+    loaded into the template.
+    """
+    key = mysql_template_key(mysqld_version, mysql_defaults_file)
+    template = os.path.join(mysql_templates_dir, key)
+    lock = mysql_template_lock(lock_dir, key)
+    while True:
+        with file_lock(lock, remove=False, timeout=timeout, shared=True):
+            if os.path.exists(template):
+                try:
+                    # the time of the last use, the template of the other user is kept fresh by its owner
+                    os.utime(template)
+                except OSError:
+                    pass
+                services_log.debug('Cloning mysql template {0} to {1}'.format(template, mysql_data_dir))
+                with trace.span('clone template', 'mysql'):
+                    clone_tree(template, mysql_data_dir)
+                return
+        with file_lock(lock, remove=False, timeout=timeout):
+            if not os.path.exists(template):
+                services_log.debug('Initializing mysql template {0}'.format(template))
+                temp = '{0}.{1}'.format(template, os.getpid())
+                shutil.rmtree(temp, ignore_errors=True)
+                os.makedirs(temp)
+                try:
+                    install_mysql_system_database(temp, mysql_base_dir, mysql_defaults_file, services_log)
+                    load_template_timezones(temp, mysql_defaults_file, lock_dir, services_log, timeout)
+                    os.rename(temp, template)
+                finally:
+                    shutil.rmtree(temp, ignore_errors=True)
+                prune_mysql_templates(mysql_templates_dir, key, lock_dir, services_log)
+
+
+def prepare_mysql_system_database(
+        request, mysql_data_dir, mysql_base_dir, mysql_defaults_file, lock_dir, services_log):
+    """Clone the system database from the template or install it if the templates are disabled.
+
+    :return: whether the timezone tables are loaded, they are in the template
+    """
+    mysql_templates_dir = request.getfixturevalue('mysql_templates_dir')
+    if mysql_templates_dir:
+        clone_mysql_template(
+            mysql_templates_dir, request.getfixturevalue('mysqld_version'), mysql_data_dir, mysql_base_dir,
+            mysql_defaults_file, lock_dir, services_log)
+        return True
+    install_mysql_system_database(mysql_data_dir, mysql_base_dir, mysql_defaults_file, services_log)
+    return False
+
+
+@pytest.fixture(scope='session')
+def mysql_templates_dir(run_services, memory_root_dir):
+    """The directory of the system database templates shared by the sessions, see `clone_mysql_template`.
+
+    Override to return a persistent directory, or None to install the system database in every session.
+    """
+    if run_services:
+        path = os.path.join(memory_root_dir, 'mysql-templates')
+        try:
+            os.mkdir(path, 0o777)
+        except OSError:
+            # concurrent already created this path
+            pass
+        try:
+            os.chmod(path, 0o777)  # shared by the users like the lock dir
+        except OSError:
+            # the directory of the other user
+            pass
+        return path
+
+
 @pytest.fixture(scope='session')
 def mysql_system_database(
+        request,
         run_services,
         mysql_data_dir,
         mysql_base_dir,
@@ -52,41 +268,61 @@ def mysql_system_database(
         memory_temp_dir,
         lock_dir,
         services_log,
+        mysql_shared_dir,
 ):
-    """Install database to given path."""
+    """Install database to given path.
+
+    The system database is cloned from the template, see `mysql_templates_dir`.
+
+    Whether the timezone tables are loaded into the system database.
+    """
     if run_services:
         pytest.skip(reason="#50 needs investigation")
-        mysqld = shutil.which('mysqld')
-        assert mysqld, 'You have to install mysqld script.'
-
-        try:
-            services_log.debug('Starting mysqld.')
-            check_output([
-                mysqld,
-                '--defaults-file={0}'.format(mysql_defaults_file),
-                '--initialize-insecure',
-                '--datadir={0}'.format(mysql_data_dir),
-                '--basedir={0}'.format(mysql_base_dir),
-                '--user={0}'.format(os.environ['USER'])
-            ])
-        except CalledProcessWithOutputError as e:
-            services_log.error(
-                '{e.cmd} failed with output:\n{e.output}\nand erorr:\n{e.err}. '
-                'Please ensure you disabled apparmor for /run/shm/** or for whole mysql'.format(e=e))
-            raise
-        finally:
-            services_log.debug('mysqld was executed.')
+        if mysql_shared_dir:
+            # installed by the session starting the shared mysqld
+            return
+        return prepare_mysql_system_database(
+            request, mysql_data_dir, mysql_base_dir, mysql_defaults_file, lock_dir, services_log)
+
+
+def install_mysql_system_database(mysql_data_dir, mysql_base_dir, mysql_defaults_file, services_log):
+    """Run `mysqld --initialize-insecure` to install the system database to given path."""
+    mysqld = which('mysqld')
+    assert mysqld, 'You have to install mysqld script.'
+
+    try:
+        services_log.debug('Starting mysqld.')
+        check_output([
+            mysqld,
+            '--defaults-file={0}'.format(mysql_defaults_file),
+            '--initialize-insecure',
+            '--datadir={0}'.format(mysql_data_dir),
+            '--basedir={0}'.format(mysql_base_dir),
+            '--user={0}'.format(os.environ['USER'])
+        ])
+    except CalledProcessWithOutputError as e:
+        services_log.error(
+            '{e.cmd} failed with output:\n{e.output}\nand erorr:\n{e.err}. '
+            'Please ensure you disabled apparmor for /run/shm/** or for whole mysql'.format(e=e))
+        raise
+    finally:
+        services_log.debug('mysqld was executed.')
 
 
 @pytest.fixture(scope='session')
 def mysql_data_dir(
-        request, memory_base_dir, memory_temp_dir, lock_dir, session_id, services_log, run_services):
+        request, memory_base_dir, memory_temp_dir, lock_dir, session_id, services_log, run_services,
+        mysql_shared_dir):
     """The root directory for the mysql instance.
 
     `mysql_install_db` is run in that directory.
 
     """
     if run_services:
+        if mysql_shared_dir:
+            # created and removed by the sessions sharing the mysqld
+            return os.path.join(mysql_shared_dir, 'data')
+
         path = os.path.join(memory_base_dir, 'mysql')
         services_log.debug('Making mysql base dir in {path}'.format(path=path))
 
@@ -100,15 +336,15 @@ def mysql_data_dir(
 
 
 @pytest.fixture(scope='session')
-def mysql_socket(run_dir):
+def mysql_socket(run_dir, mysql_shared_dir):
     """The mysqld socket location."""
-    return os.path.join(run_dir, 'mysql.sock')
+    return os.path.join(mysql_shared_dir or run_dir, 'mysql.sock')
 
 
 @pytest.fixture(scope='session')
-def mysql_pid(run_dir):
+def mysql_pid(run_dir, mysql_shared_dir):
     """The pid file of the mysqld."""
-    return os.path.join(run_dir, 'mysql.pid')
+    return os.path.join(mysql_shared_dir or run_dir, 'mysql.pid')
 
 
 @pytest.fixture(scope='session')
@@ -118,49 +354,267 @@ def mysql_connection(run_services, mysql_socket):
         return 'mysql://root@localhost/?unix_socket={0}&charset=utf8'.format(mysql_socket)
 
 
+def mysql_arguments(mysql_defaults_file, mysql_data_dir, mysql_pid, mysql_socket):
+    """The mysqld command line arguments."""
+    return [
+        '--defaults-file={0}'.format(mysql_defaults_file),
+        '--datadir={mysql_data_dir}'.format(mysql_data_dir=mysql_data_dir),
+        '--pid-file={mysql_pid}'.format(mysql_pid=mysql_pid),
+        '--socket={mysql_socket}'.format(mysql_socket=mysql_socket),
+        '--skip-networking',
+    ]
+
+
+def running_mysql(mysql_pid):
+    """The running mysqld process according to the pid file, None if it is not running."""
+    try:
+        with open(mysql_pid) as fd:
+            process = psutil.Process(int(fd.read().strip()))
+        if process.is_running() and process.status() != psutil.STATUS_ZOMBIE and 'mysqld' in process.name():
+            return process
+    except (IOError, ValueError, psutil.Error):
+        pass
+    return None
+
+
+def stop_mysql(process, timeout):
+    """Terminate the mysqld process, kill it if it doesn't exit in time.
+
+    :return: whether the process is stopped, False if it is owned by another user
+    """
+    try:
+        process.terminate()
+        try:
+            process.wait(timeout / 2)
+        except psutil.TimeoutExpired:
+            process.kill()
+            process.wait(timeout / 2)
+    except psutil.NoSuchProcess:
+        pass
+    except psutil.AccessDenied:
+        return False
+    return True
+
+
+def leave_shared_mysql(sessions, session_id):
+    """Remove the session of this process and the sessions of the dead processes from the shared mysqld sessions.
+
+    :param sessions: the `mysql-shared` resource list, modified in place
+    """
+    sessions[:] = [
+        entry for entry in sessions
+        if not (entry == session_id or (
+            isinstance(entry, dict) and entry['resource'] == session_id and entry.get('pid') == os.getpid()))
+    ]
+    sweep_resources(sessions)
+
+
+def zoneinfo_fingerprint(zoneinfo):
+    """Hash of the paths, sizes and modification times of the files of the zoneinfo tree."""
+    key = hashlib.sha256()
+    for root, dirs, files in os.walk(zoneinfo):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            key.update('{0} {1} {2}\n'.format(
+                os.path.relpath(path, zoneinfo), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return key.hexdigest()[:16]
+
+
+def mysql_tzinfo_sql(lock_dir, zoneinfo='/usr/share/zoneinfo', timeout=120):
+    """The file of the SQL loading the timezone tables, in the lock dir.
+
+    The SQL is generated by `mysql_tzinfo_to_sql` once per zoneinfo tree, see `zoneinfo_fingerprint`, the files
+    of the previous zoneinfo trees are removed then.
+    """
+    name = 'mysql-tzinfo-{0}.sql'.format(zoneinfo_fingerprint(zoneinfo))
+    path = os.path.join(lock_dir, name)
+    if not os.path.exists(path):
+        with file_lock(os.path.join(lock_dir, 'mysql-tzinfo.lock'), timeout=timeout):
+            if not os.path.exists(path):
+                with trace.span('mysql_tzinfo_to_sql', 'mysql'):
+                    output, _ = check_output(['mysql_tzinfo_to_sql', zoneinfo])
+                temp = '{0}.{1}'.format(path, os.getpid())
+                with open(temp, 'wb') as fd:
+                    fd.write(output)
+                os.rename(temp, path)
+                for other in os.listdir(lock_dir):
+                    if other.startswith('mysql-tzinfo-') and other.endswith('.sql') and other != name:
+                        try_remove(os.path.join(lock_dir, other))
+    return path
+
+
+def load_mysql_timezones(mysql_socket, lock_dir, services_log):
+    """Load the timezone tables to the mysql schema of the server."""
+    sql = mysql_tzinfo_sql(lock_dir)
+    services_log.debug('Loading mysql timezones from {0}'.format(sql))
+    with trace.span('load timezones', 'mysql'), open(sql, 'rb') as fd:
+        check_output(['mysql', '--user=root', '--socket={0}'.format(mysql_socket), 'mysql'], stdin=fd)
+
+
+def load_template_timezones(mysql_data_dir, mysql_defaults_file, lock_dir, services_log, timeout=120):
+    """Start mysqld on the template data dir, load the timezone tables and stop it."""
+    executable = which('mysqld')
+    assert executable, 'You have to install mysqld executable.'
+    run_dir = tempfile.mkdtemp(prefix='pytest-services-mysql-template-')
+    try:
+        mysql_socket = os.path.join(run_dir, 'mysql.sock')
+        watcher = subprocess.Popen(
+            [executable] + mysql_arguments(
+                mysql_defaults_file, mysql_data_dir, os.path.join(run_dir, 'mysql.pid'), mysql_socket),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_service(
+                'mysqld', watcher, MySQLHandshake(mysql_socket), timeout, MySQLHandshake.poll_schedule)
+            load_mysql_timezones(mysql_socket, lock_dir, services_log)
+        finally:
+            stop_mysql(psutil.Process(watcher.pid), timeout)
+            watcher.wait()
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def mysql_shared_timeout():
+    """Max number of seconds to start or stop the shared mysqld."""
+    return 120
+
+
+def shared_mysql_watcher(
+        request, session_id, lock_dir, services_log, watcher_poll_schedule, mysql_shared_timeout,
+        mysql_shared_dir, mysql_base_dir, mysql_defaults_file, mysql_data_dir, mysql_pid, mysql_socket):
+    """Use the shared mysqld, start it if it is not running.
+
+    The sessions using the server are registered in the `mysql-shared` resource list with their owner processes,
+    the last one stops it. The sessions of the crashed processes are swept from the list.
+
+    :return: psutil.Process object of the mysqld
+    """
+    with locked_resources('mysql-shared', lock_dir, timeout=mysql_shared_timeout) as sessions:
+        sweep_resources(sessions)
+        process = running_mysql(mysql_pid)
+        if process is None:
+            del sessions[:]
+            # the directory is removed by the last session under the lock
+            for directory in (mysql_shared_dir, os.path.join(mysql_shared_dir, 'tmp')):
+                try:
+                    os.mkdir(directory)
+                except OSError:
+                    # the previous shared mysqld died without removing it
+                    pass
+            for path in (mysql_socket, mysql_pid):
+                try_remove(path)
+            write_mysql_defaults_file(mysql_defaults_file, os.path.join(mysql_shared_dir, 'tmp'))
+            timezones = False
+            if not os.path.exists(mysql_data_dir):
+                os.mkdir(mysql_data_dir)
+                timezones = prepare_mysql_system_database(
+                    request, mysql_data_dir, mysql_base_dir, mysql_defaults_file, lock_dir, services_log)
+
+            executable = which('mysqld')
+            assert executable, 'You have to install mysqld executable.'
+            services_log.debug('Starting shared mysqld: {0}'.format(mysql_shared_dir))
+            watcher = subprocess.Popen(
+                [executable] + mysql_arguments(mysql_defaults_file, mysql_data_dir, mysql_pid, mysql_socket),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                # the server should outlive this session
+                start_new_session=True,
+            )
+            wait_for_service(
+                'mysqld', watcher, MySQLHandshake(mysql_socket), mysql_shared_timeout, watcher_poll_schedule)
+            process = psutil.Process(watcher.pid)
+            if not timezones:
+                load_mysql_timezones(mysql_socket, lock_dir, services_log)
+        sessions.append(owner_entry(session_id))
+
+    def finalize():
+        with locked_resources('mysql-shared', lock_dir, timeout=mysql_shared_timeout) as sessions:
+            leave_shared_mysql(sessions, session_id)
+            if not sessions:
+                services_log.debug('Stopping shared mysqld: {0}'.format(mysql_shared_dir))
+                if stop_mysql(process, mysql_shared_timeout):
+                    shutil.rmtree(mysql_shared_dir, ignore_errors=True)
+                else:
+                    services_log.debug('Shared mysqld is owned by another user, leaving it running')
+    request.addfinalizer(finalize)
+    return process
+
+
 @pytest.fixture(scope='session')
 def mysql_watcher(
         request, run_services, watcher_getter, mysql_system_database, mysql_pid, mysql_socket, mysql_data_dir,
-        mysql_defaults_file):
-    """The mysqld process watcher."""
+        mysql_defaults_file, mysql_shared_dir, mysql_base_dir, mysql_shared_timeout, session_id, lock_dir,
+        services_log, watcher_poll_schedule):
+    """The mysqld process watcher.
+
+    psutil.Process object of the shared mysqld if the server is shared.
+
+    The timezone tables are loaded once the server is started, unless they are in the template.
+    """
     if run_services:
-        return watcher_getter(
+        if mysql_shared_dir:
+            return shared_mysql_watcher(
+                request, session_id, lock_dir, services_log, watcher_poll_schedule, mysql_shared_timeout,
+                mysql_shared_dir, mysql_base_dir, mysql_defaults_file, mysql_data_dir, mysql_pid, mysql_socket)
+
+        watcher = watcher_getter(
             'mysqld',
-            [
-                '--defaults-file={0}'.format(mysql_defaults_file),
-                '--datadir={mysql_data_dir}'.format(mysql_data_dir=mysql_data_dir),
-                '--pid-file={mysql_pid}'.format(mysql_pid=mysql_pid),
-                '--socket={mysql_socket}'.format(mysql_socket=mysql_socket),
-                '--skip-networking',
-            ],
-            checker=lambda: os.path.exists(mysql_socket),
+            mysql_arguments(mysql_defaults_file, mysql_data_dir, mysql_pid, mysql_socket),
+            checker=MySQLHandshake(mysql_socket),
             request=request,
         )
+        if not mysql_system_database:
+            load_mysql_timezones(mysql_socket, lock_dir, services_log)
+        return watcher
 
 
 @pytest.fixture(scope='session')
-def mysql_database_name():
-    """Name of test database to be created."""
+def mysql_database_name(mysql_shared_dir, worker_id, session_id):
+    """Name of test database to be created.
+
+    Unique for the test session if the mysqld is shared.
+    """
+    if mysql_shared_dir:
+        return 'pytest_services_test_{0}_{1}'.format(worker_id, session_id[:8])
     return 'pytest_services_test'
 
 
 @pytest.fixture(scope='session')
-def mysql_database_getter(run_services, mysql_watcher, mysql_socket):
-    """Prepare new test database creation function."""
+def mysql_database_getter(request, run_services, mysql_watcher, mysql_socket, mysql_shared_dir):
+    """Prepare new test database creation function.
+
+    The databases are dropped at the end of the session if the mysqld is shared. The timezone tables are
+    server-wide, they are loaded by the `mysql_watcher`.
+    """
     if run_services:
         def getter(database_name):
-            check_output(
-                [
-                    'mysql',
-                    '--user=root',
-                    '--socket={0}'.format(mysql_socket),
-                    '--execute=create database {0};'.format(database_name),
-                ],
-            )
-            check_output(
-                'mysql_tzinfo_to_sql /usr/share/zoneinfo | mysql --user=root --socket={0} mysql'.format(mysql_socket),
-                shell=True
-            )
+            with trace.span('create database', 'mysql', database=database_name):
+                check_output(
+                    [
+                        'mysql',
+                        '--user=root',
+                        '--socket={0}'.format(mysql_socket),
+                        '--execute=create database {0};'.format(database_name),
+                    ],
+                )
+            if mysql_shared_dir:
+                request.addfinalizer(lambda: check_output(
+                    [
+                        'mysql',
+                        '--user=root',
+                        '--socket={0}'.format(mysql_socket),
+                        '--execute=drop database if exists {0};'.format(database_name),
+                    ],
+                ))
         return getter
 
 
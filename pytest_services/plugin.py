@@ -2,14 +2,34 @@
 
 Provides an easy way of running service processes for your tests.
 """
+import logging
+import os
 
+import pytest
+
+from . import contention, hooks, trace
 from .folders import *  # NOQA
 from .log import *  # NOQA
 from .locks import *  # NOQA
+from .allocators import *  # NOQA
+from .probes import *  # NOQA
 from .xvfb import *  # NOQA
 from .memcached import *  # NOQA
 from .mysql import *  # NOQA
 from .service import *  # NOQA
+from .timings import *  # NOQA
+from .teardown import *  # NOQA
+from .async_service import *  # NOQA
+from .broker import *  # NOQA
+
+
+# The lock contention metrics of the enclosing test session, restored on unconfigure (eg. in pytester).
+previous_contention_key = pytest.StashKey()
+
+
+def pytest_addhooks(pluginmanager):
+    """Register the hooks of the services plugin."""
+    pluginmanager.add_hookspecs(hooks)
 
 
 def pytest_addoption(parser):
@@ -25,3 +45,163 @@ def pytest_addoption(parser):
         action="store", dest="display",
         default=None,
         help="X display to use")
+    group._addoption(
+        '--services-allocator',
+        action="store", dest="services_allocator",
+        default="registry", choices=["registry", "fcntl", "daemon"],
+        help="Allocator of the ports and displays: registry (shared list of the bound resources, the default), "
+             "fcntl (lock per resource, released by the kernel when the process dies) "
+             "or daemon (allocator daemon leasing the resources to the connected sessions)")
+    group._addoption(
+        '--services-port-range',
+        action="store", dest="services_port_range",
+        default="30000-32767", metavar="FIRST-LAST",
+        help="Range of the ports allocated by port_getter, keep it out of the ephemeral port range")
+    group._addoption(
+        '--services-port-partitions',
+        action="store", dest="services_port_partitions",
+        default=0, type=int, metavar="SIZE",
+        help="Allocate the ports from the per-worker slices of the given size of the port partitions range, "
+             "without locking the shared registry")
+    group._addoption(
+        '--services-port-partitions-range',
+        action="store", dest="services_port_partitions_range",
+        default="20000-29999", metavar="FIRST-LAST",
+        help="Range of the ports split into the per-worker slices by --services-port-partitions")
+    group._addoption(
+        '--services-gc-locks',
+        action="store", dest="services_gc_locks", nargs="?", const=True,
+        default=False, metavar="LOCK_DIR",
+        help="Remove the resources of the dead owners from the registries in the lock dir and exit. "
+             "The default lock dir is used unless the LOCK_DIR is given")
+    group._addoption(
+        '--mysql-shared',
+        action="store_true", dest="mysql_shared",
+        default=False,
+        help="Share a single mysqld between all the test sessions on the host")
+    group._addoption(
+        '--services-timings',
+        action="store", dest="services_timings",
+        default=None, metavar="path",
+        help="Write the startup and teardown timings of the services to the JSON file")
+    group._addoption(
+        '--services-trace',
+        action="store", dest="services_trace",
+        default=None, metavar="path",
+        help="Write the Trace Event Format profile of the service fixtures to the JSON file")
+    group._addoption(
+        '--services-parallel-teardown',
+        action="store_true", dest="services_parallel_teardown",
+        default=False,
+        help="Stop the session services at once at the end of the test session")
+    group._addoption(
+        '--xvfb-displayfd',
+        action="store_true", dest="xvfb_displayfd",
+        default=False,
+        help="Let Xvfb choose a free display itself and report it when it is ready (-displayfd), "
+             "the clients connect over the unix socket")
+    group._addoption(
+        '--xvfb-pool',
+        action="store", dest="xvfb_pool",
+        default=0, type=int, metavar="SIZE",
+        help="Lease the display from the pool of the given size of the pre-warmed Xvfb servers kept by the service "
+             "broker")
+    group._addoption(
+        '--xvfb-pool-display',
+        action="store", dest="xvfb_pool_display",
+        default=1000, type=int, metavar="DISPLAY",
+        help="The first display of the Xvfb pool")
+    group._addoption(
+        '--services-broker',
+        action="store_true", dest="services_broker",
+        default=False,
+        help="Lease reusable services from the persistent service broker")
+    group._addoption(
+        '--services-broker-idle-timeout',
+        action="store", dest="services_broker_idle_timeout",
+        type=float, default=600,
+        help="Number of seconds after which the idle services of the broker are stopped")
+
+
+def pytest_cmdline_main(config):
+    """Compact the resource registries with `--services-gc-locks`."""
+    if config.option.services_gc_locks:
+        lock_dir = config.option.services_gc_locks
+        if lock_dir is True:
+            # the root_dir and memory_root_dir fixtures are not available here, they are given by the LOCK_DIR
+            lock_dir = get_lock_dir(get_memory_root_dir('/tmp'))
+        config._do_configure()
+        tw = config.get_terminal_writer()
+        if os.path.isdir(lock_dir):
+            for name, removed in gc_locks(lock_dir, logging.getLogger(__name__)).items():
+                tw.line('{0}: {1} entries removed'.format(os.path.join(lock_dir, name), len(removed)))
+        config._ensure_unconfigure()
+        return 0
+
+
+def pytest_configure(config):
+    """Initialize the services timings, lock contention metrics, teardown and tracing."""
+    config.stash[timings_key] = ServiceTimings()
+    stats = contention.LockContention(getattr(config, 'workerinput', {}).get('workerid', 'local'))
+    config.stash[contention.contention_key] = stats
+    config.stash[previous_contention_key], contention.stats = contention.stats, stats
+    config.stash[teardown_key] = ServicesTeardown(config.option.services_parallel_teardown)
+    if config.option.services_trace:
+        worker = getattr(config, 'workerinput', {}).get('workerid', 'local')
+        # the workers are shown after the controller or the single process
+        trace.tracer = trace.Tracer(worker, worker_index(worker) + 1 if worker != 'local' else 0)
+
+
+def pytest_unconfigure(config):
+    """Stop the tracing and the lock contention metrics."""
+    trace.tracer = None
+    contention.stats = config.stash.get(previous_contention_key, None)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_teardown(item, nextitem):
+    """Mark the teardown of the last test, which finalizes the session services."""
+    if nextitem is None:
+        item.config.stash[teardown_key].final = True
+    yield
+
+
+def pytest_sessionfinish(session):
+    """Pass the services timings, lock contention and trace to the xdist controller or write them to the files."""
+    timings = get_timings(session.config)
+    if hasattr(session.config, 'workeroutput'):
+        session.config.workeroutput['services_timings'] = timings.records
+        session.config.workeroutput['services_lock_contention'] = contention.get_contention(session.config).records
+        if trace.tracer is not None:
+            session.config.workeroutput['services_trace'] = trace.tracer.events
+        return
+    session.config.hook.pytest_services_lock_contention(
+        config=session.config, records=contention.get_contention(session.config).records)
+    if session.config.option.services_timings:
+        timings.dump(session.config.option.services_timings)
+    if trace.tracer is not None:
+        trace.tracer.dump(session.config.option.services_trace)
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    """Collect the services timings and trace events of the xdist worker."""
+    workeroutput = getattr(node, 'workeroutput', {})
+    get_timings(node.config).records.extend(workeroutput.get('services_timings', []))
+    contention.get_contention(node.config).records.extend(workeroutput.get('services_lock_contention', []))
+    if trace.tracer is not None:
+        trace.tracer.events.extend(workeroutput.get('services_trace', []))
+
+
+def pytest_terminal_summary(terminalreporter):
+    """Show the services timings and lock contention."""
+    timings = get_timings(terminalreporter.config)
+    if timings.records:
+        terminalreporter.write_sep('=', 'services timings')
+        for line in timings.summary():
+            terminalreporter.write_line(line)
+    records = contention.get_contention(terminalreporter.config).records
+    if records:
+        terminalreporter.write_sep('=', 'services lock contention')
+        for line in contention.summary(records):
+            terminalreporter.write_line(line)
@@ -0,0 +1,90 @@
+"""Cache of the capabilities and versions of the service binaries."""
+import json
+import os
+import shutil
+import threading
+try:
+    import subprocess32 as subprocess
+except ImportError:  # pragma: no cover
+    import subprocess
+
+import pytest
+
+from .locks import file_lock
+
+# The executables found by `which`, per PATH.
+executables = {}
+
+
+def which(name):
+    """Locate the executable like `shutil.which`, remembering the found ones for the current PATH."""
+    key = (name, os.environ.get('PATH', os.defpath))
+    if key not in executables:
+        executable = shutil.which(name)
+        if executable is None:
+            return None
+        executables[key] = executable
+    return executables[key]
+
+
+class ProbeCache(object):
+
+    """Cache of the probes of the service binaries, shared by all the sessions on the host.
+
+    The value of the probe is kept in the JSON file in the lock dir, keyed by the resolved path of the binary and
+    the name of the probe, along with the mtime and size of the binary. The probe is run again only when the binary
+    is updated. The file is locked while the probe runs, so the concurrent sessions run it once.
+    """
+
+    def __init__(self, path):
+        """Assign the path of the cache file."""
+        self.path = path
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def probe(self, name, probe, function):
+        """Get the cached value of the probe, run the probe if the binary was changed.
+
+        :param name: the executable name or path
+        :param probe: the name of the probe
+        :param function: function called with the executable path, returning the JSON serializable value
+        """
+        executable = which(name)
+        assert executable, 'You have to install {0} executable.'.format(name)
+        path = os.path.realpath(executable)
+        stat = os.stat(path)
+        fingerprint = [stat.st_mtime_ns, stat.st_size]
+        key = '{0} {1}'.format(path, probe)
+
+        with self.lock:
+            if key in self.values and self.values[key]['fingerprint'] == fingerprint:
+                return self.values[key]['value']
+            with file_lock(self.path, remove=False) as fd:
+                try:
+                    probes = json.loads(fd.read())
+                except ValueError:
+                    probes = {}
+                if not isinstance(probes, dict):
+                    probes = {}
+                entry = probes.get(key)
+                if entry is None or entry['fingerprint'] != fingerprint:
+                    entry = probes[key] = dict(fingerprint=fingerprint, value=function(executable))
+                    fd.seek(0)
+                    fd.truncate()
+                    fd.write(json.dumps(probes, indent=2, sort_keys=True))
+                    fd.flush()
+            self.values[key] = entry
+            return entry['value']
+
+
+def version(executable, option='--version'):
+    """The first line of the version output of the executable."""
+    output = subprocess.run(
+        [executable, option], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=30).stdout
+    return output.decode('utf-8', 'replace').strip().split('\n')[0]
+
+
+@pytest.fixture(scope='session')
+def services_probes(lock_dir):
+    """Cache of the capabilities and versions of the service binaries, see `ProbeCache`."""
+    return ProbeCache(os.path.join(lock_dir, 'service-probes.json'))
@@ -1,6 +1,9 @@
 """Service fixtures."""
+import concurrent.futures
+import os
 import time
 import re
+import sys
 import warnings
 try:
     import subprocess32 as subprocess
@@ -8,9 +11,12 @@ except ImportError:  # pragma: no cover
     import subprocess
 import uuid  # pylint: disable=C0411
 
-from shutil import which
 import pytest
 
+from . import trace
+from .broker import lease_service
+from .probes import which
+
 WRONG_FILE_NAME_CHARS_RE = re.compile(r'[^\w_-]')
 
 
@@ -34,6 +40,12 @@ def worker_id(request):
     return WRONG_FILE_NAME_CHARS_RE.sub('_', getattr(request.config, 'workerinput', {}).get('workerid', 'local'))
 
 
+def worker_index(worker_id):
+    """Index of the xdist worker, eg. 3 for `gw3` and 0 for `local`."""
+    match = re.search(r'\d+$', worker_id)
+    return int(match.group()) if match else 0
+
+
 @pytest.fixture(scope='session')
 def slave_id(request, worker_id):
     msg = "The `slave_id` fixture is deprecated; use `worker_id` instead."
@@ -58,53 +70,210 @@ def session_id(request, worker_id, run_services):
 
 
 @pytest.fixture(scope='session')
-def watcher_getter(request, services_log):
+def watcher_poll_schedule():
+    """Readiness polling schedule of the watcher_getter.
+
+    Tuple in form `(first delay, factor, max delay)`, delays are in seconds.
+    """
+    return (0.005, 2, 0.5)
+
+
+def poll_delays(schedule):
+    """Generate delays between the readiness checks for the given polling schedule."""
+    delay, factor, max_delay = schedule
+    while True:
+        yield delay
+        delay = min(delay * factor, max_delay)
+
+
+def wait_for_service(name, watcher, checker, timeout, schedule):
+    """Wait for the service to start.
+
+    :param name: service name used in the error messages
+    :param watcher: Popen object of the service
+    :param checker: callable returning True when the service is ready. If it has a `wait(timeout)` method,
+        it is used to block until the service is ready instead of sleeping between the checks.
+    :param timeout: number of seconds to wait for the service
+    :param schedule: polling schedule, see `watcher_poll_schedule`
+    :return: tuple in form `(seconds it took to become ready, number of checker attempts)`
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    attempts = 0
+    wait = getattr(checker, 'wait', None)
+    for delay in poll_delays(schedule):
+        attempts += 1
+        if checker():
+            return time.monotonic() - start, attempts
+
+        if watcher.poll() is not None:
+            raise Exception("Error running {0}".format(name))
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception('The {0} service checked did not succeed!'.format(name))
+
+        if wait is None:
+            time.sleep(min(delay, remaining))
+        elif wait(min(delay, remaining)):
+            return time.monotonic() - start, attempts
+
+
+# Program of the python which moves the sockets passed as the descriptors in its first argument to the
+# descriptors 3, 4, ... and execs the service in its other arguments, see `socket_activation`.
+ACTIVATE_SOCKETS = """
+import fcntl, os, sys
+fds = [int(fd) for fd in sys.argv[1].split(',')]
+# move the descriptors out of the way first, so they are not overwritten by each other
+moved = [fcntl.fcntl(fd, fcntl.F_DUPFD_CLOEXEC, 3 + len(fds)) for fd in fds]
+for index, fd in enumerate(moved):
+    os.dup2(fd, 3 + index)
+for fd in fds:
+    if fd >= 3 + len(fds):
+        os.close(fd)
+os.environ.update(LISTEN_PID=str(os.getpid()), LISTEN_FDS=str(len(fds)))
+os.execvp(sys.argv[2], sys.argv[2:])
+"""
+
+
+def socket_activation(cmd, sockets, kwargs=None):
+    """Command line and Popen arguments of the service receiving the listening sockets (systemd socket activation).
+
+    The service gets the sockets as the descriptors starting at 3 and the `LISTEN_FDS` and `LISTEN_PID`
+    environment variables. `LISTEN_PID` is the pid of the service, so the descriptors are renumbered by a python
+    which then execs the service, not by a `preexec_fn`, which is not safe in the process with threads.
+    """
+    kwargs = dict(kwargs or {})
+    fds = [sock.fileno() for sock in sockets]
+    kwargs.update(pass_fds=tuple(kwargs.get('pass_fds', ())) + tuple(fds))
+    cmd = [sys.executable, '-c', ACTIVATE_SOCKETS, ','.join(str(fd) for fd in fds)] + list(cmd)
+    return cmd, kwargs
+
+
+@pytest.fixture(scope='session')
+def watcher_getter(request, services_log, watcher_poll_schedule, services_timings, services_teardown):
     """Popen object of given executable name and it's arguments.
 
     Wait for the process to start.
     Add finalizer to properly stop it.
+
+    Several services can be started at once with `watcher_getter.start_many`.
+
+    With `reuse=True` the service is leased from the service broker, if it is enabled, instead of being
+    started. Only the `cwd` and `env` of the `kwargs` are passed to the broker. The `reset` callable is called
+    when the leased service was already running.
+
+    The startup and teardown timings of the service are recorded in the `services_timings`.
+
+    With `--services-parallel-teardown` the session services are stopped at once by the `services_teardown`,
+    a service is stopped only after the services which declare it in their `depends_on` list of watchers.
+
+    The listening `sockets` (see `socket_getter`) are passed to the started service by the systemd socket
+    activation protocol, so no one can take their ports before the service listens on them. With
+    `pass_sockets=False`, for the services which can't accept the sockets, the sockets are closed right before
+    the service is started instead.
     """
     orig_request = request
 
-    def watcher_getter_function(name, arguments=None, kwargs=None, timeout=20, checker=None, request=None):
-        if request is None:
-            warnings.warn('Omitting the `request` parameter will result in an unstable order of finalizers.')
-            request = orig_request
+    def start_watcher(
+            name, arguments=None, kwargs=None, timeout=20, request=None, reuse=False, depends_on=None,
+            sockets=None, pass_sockets=True):
+        """Start the service process and add the finalizer to stop it."""
         executable = which(name)
         assert executable, 'You have to install {0} executable.'.format(name)
 
         cmd = [name] + (arguments or [])
 
-        services_log.debug('Starting {0}: {1}'.format(name, arguments))
+        watcher = None
+        timing = services_timings.start('service', name)
+        broker = orig_request.getfixturevalue('services_broker') if reuse else None
+        if broker:
+            services_log.debug('Leasing {0}: {1}'.format(name, arguments))
+            watcher = lease_service(
+                broker, [executable] + (arguments or []), **{
+                    key: value for key, value in (kwargs or {}).items() if key in ('cwd', 'env')})
+        if watcher is None:
+            services_log.debug('Starting {0}: {1}'.format(name, arguments))
 
-        watcher = subprocess.Popen(
-            cmd, **(kwargs or {}))
+            if sockets and pass_sockets:
+                cmd, kwargs = socket_activation(cmd, sockets, kwargs)
+            elif sockets:
+                for sock in sockets:
+                    sock.close()
+            watcher = subprocess.Popen(
+                cmd, **(kwargs or {}))
+
+        watcher.timing = timing
+        if request.scope == 'session':
+            services_teardown.register(watcher, timeout, depends_on)
 
         def finalize():
-            try:
-                watcher.terminate()
-            except OSError:
-                pass
-            if watcher.returncode is None:
+            if services_teardown.stop(watcher):
+                return
+            with services_timings.measure(timing, 'teardown'), trace.span('teardown', 'service', name=name):
                 try:
-                    watcher.communicate(timeout=timeout / 2)
-                except subprocess.TimeoutExpired:
-                    watcher.kill()
-                    watcher.communicate(timeout=timeout / 2)
+                    watcher.terminate()
+                except OSError:
+                    pass
+                if watcher.returncode is None:
+                    try:
+                        watcher.communicate(timeout=timeout / 2)
+                    except subprocess.TimeoutExpired:
+                        timing['killed'] = True
+                        watcher.kill()
+                        watcher.communicate(timeout=timeout / 2)
         request.addfinalizer(finalize)
+        return watcher
 
-        # Wait for the service to start.
-        times = 0
-        while not checker():
-            if watcher.returncode is not None:
-                raise Exception("Error running {0}".format(name))
+    def wait_watcher(watcher, name, timeout=20, checker=None, reset=None):
+        """Wait for the started service to be ready."""
+        watcher.startup_duration, attempts = wait_for_service(
+            name, watcher, checker, timeout, watcher_poll_schedule)
+        watcher.timing.update(ready=watcher.startup_duration, attempts=attempts)
+        services_log.debug('{0} is ready in {1:.3f}s after {2} checks'.format(
+            name, watcher.startup_duration, attempts))
+        if reset is not None and getattr(watcher, 'warm', False):
+            reset()
+        return watcher
 
-            if times > timeout:
-                raise Exception('The {0} service checked did not succeed!'.format(name))
+    def get_request(request):
+        if request is None:
+            warnings.warn('Omitting the `request` parameter will result in an unstable order of finalizers.')
+            return orig_request
+        return request
 
-            time.sleep(1)
-            times += 1
+    def watcher_getter_function(
+            name, arguments=None, kwargs=None, timeout=20, checker=None, request=None, reuse=False, reset=None,
+            depends_on=None, sockets=None, pass_sockets=True):
+        with trace.span('watcher_getter', 'service', name=name):
+            watcher = start_watcher(
+                name, arguments, kwargs, timeout, get_request(request), reuse, depends_on, sockets, pass_sockets)
+            return wait_watcher(watcher, name, timeout, checker, reset)
 
-        return watcher
+    def start_many(services, request=None):
+        """Start several services at once and wait for all of them to be ready concurrently.
+
+        The services are started in the given order, so they are finalized in the reverse one.
+
+        :param services: list of dicts with the `watcher_getter` arguments of every service,
+            except the `request`
+        :return: list of watchers in the order of the services
+        """
+        request = get_request(request)
+        started = []
+        for service in services:
+            service = dict(service)
+            checker = service.pop('checker', None)
+            reset = service.pop('reset', None)
+            started.append((start_watcher(request=request, **service), service, checker, reset))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(started) or 1) as executor, trace.span(
+                'watcher_getter.start_many', 'service', names=[service['name'] for service in services]):
+            futures = [
+                executor.submit(wait_watcher, watcher, service['name'], service.get('timeout', 20), checker, reset)
+                for watcher, service, checker, reset in started
+            ]
+            return [future.result() for future in futures]
 
+    watcher_getter_function.start_many = start_many
     return watcher_getter_function
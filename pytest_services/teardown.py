@@ -0,0 +1,101 @@
+"""Parallel teardown of the session services."""
+import time
+try:
+    import subprocess32 as subprocess
+except ImportError:  # pragma: no cover
+    import subprocess
+
+import pytest
+
+from . import trace
+
+teardown_key = pytest.StashKey()
+
+
+class ServicesTeardown(object):
+
+    """Coordinator stopping the session services at once at the end of the test session.
+
+    All the services are terminated at the same time and waited for with a single deadline, the ones which
+    don't exit in time are killed. A service is stopped only after the services depending on it.
+    """
+
+    def __init__(self, enabled=False):
+        """Initialize the services."""
+        self.enabled = enabled
+        self.final = False
+        self.watchers = []
+
+    def register(self, watcher, timeout, depends_on=None):
+        """Register the session service.
+
+        :param watcher: Popen object of the service
+        :param timeout: number of seconds to wait for the service to exit, and then for it to be killed
+        :param depends_on: watchers of the services this service depends on
+        """
+        watcher.stop_timeout = timeout
+        watcher.depends_on = list(depends_on or [])
+        self.watchers.append(watcher)
+
+    def stop(self, watcher):
+        """Stop the service together with all the other registered services, at the end of the test session.
+
+        The services are stopped by the finalizer of the earliest registered service, which runs after the
+        finalizers of the fixtures using any of the services. The finalizers of the other services do nothing.
+
+        :return: whether the service was stopped, or will be stopped by the earliest registered service
+        """
+        if not (self.enabled and self.final and watcher in self.watchers):
+            return False
+        if watcher is not self.watchers[0]:
+            return True
+        with trace.span('parallel teardown', 'service', count=len(self.watchers)):
+            self.stop_all()
+        return True
+
+    def stop_all(self):
+        """Stop the registered services in the dependency order."""
+        remaining, self.watchers = self.watchers, []
+        while remaining:
+            group = [
+                watcher for watcher in remaining
+                if not any(watcher in other.depends_on for other in remaining if other is not watcher)
+            ] or remaining
+            stop_group(group)
+            remaining = [watcher for watcher in remaining if watcher not in group]
+
+
+def wait_group(watchers, deadline):
+    """Wait for the services to exit until the deadline."""
+    for watcher in watchers:
+        try:
+            watcher.communicate(timeout=max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def stop_group(watchers):
+    """Terminate the services at once, kill the ones which don't exit in time."""
+    start = time.monotonic()
+    timeout = max(watcher.stop_timeout for watcher in watchers) / 2
+    for watcher in watchers:
+        try:
+            watcher.terminate()
+        except OSError:
+            pass
+    wait_group(watchers, start + timeout)
+
+    stragglers = [watcher for watcher in watchers if watcher.poll() is None]
+    for watcher in stragglers:
+        watcher.timing['killed'] = True
+        watcher.kill()
+    wait_group(stragglers, time.monotonic() + timeout)
+
+    for watcher in watchers:
+        watcher.timing['teardown'] = time.monotonic() - start
+
+
+@pytest.fixture(scope='session')
+def services_teardown(request):
+    """The coordinator of the parallel teardown of the session services."""
+    return request.config.stash[teardown_key]
@@ -0,0 +1,86 @@
+"""Startup and teardown timings of the services."""
+import contextlib
+import json
+import time
+
+import pytest
+
+timings_key = pytest.StashKey()
+
+
+class ServiceTimings(object):
+
+    """Timeline of the services and directories of the test session.
+
+    Every record is a dict with the following keys:
+
+    * worker: id of the worker which created the record
+    * kind: `service` or `directory`
+    * name: name of the service executable or the directory fixture
+    * started: unix time of the process spawn or the directory creation
+    * ready: number of seconds it took the service to pass the checker
+    * attempts: number of checker attempts
+    * teardown: number of seconds the teardown took
+    * killed: whether the service had to be killed on teardown
+    """
+
+    def __init__(self, worker='local'):
+        """Initialize the records."""
+        self.worker = worker
+        self.records = []
+
+    def start(self, kind, name):
+        """Add the record of the started service or created directory."""
+        record = dict(
+            worker=self.worker, kind=kind, name=name, started=time.time(),
+            ready=None, attempts=None, teardown=None, killed=False,
+        )
+        self.records.append(record)
+        return record
+
+    @contextlib.contextmanager
+    def measure(self, record, key):
+        """Measure the duration of the context and store it in the record under the given key."""
+        start = time.monotonic()
+        try:
+            yield record
+        finally:
+            record[key] = time.monotonic() - start
+
+    def dump(self, path):
+        """Write the records to the JSON file."""
+        with open(path, 'w') as fd:
+            json.dump(self.records, fd, indent=2)
+
+    def summary(self):
+        """Lines of the summary table."""
+        def seconds(value):
+            return '-' if value is None else '{0:.3f}s'.format(value)
+
+        rows = [('worker', 'kind', 'name', 'ready', 'checks', 'teardown', 'killed')] + [
+            (
+                record['worker'],
+                record['kind'],
+                record['name'],
+                seconds(record['ready']),
+                '-' if record['attempts'] is None else str(record['attempts']),
+                seconds(record['teardown']),
+                'yes' if record['killed'] else 'no',
+            )
+            for record in sorted(self.records, key=lambda record: (record['worker'], record['started']))
+        ]
+        widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+        return ['  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows]
+
+
+def get_timings(config):
+    """The timings of the test session."""
+    return config.stash[timings_key]
+
+
+@pytest.fixture(scope='session')
+def services_timings(request, worker_id):
+    """The timeline of the services and directories of the test session."""
+    timings = get_timings(request.config)
+    timings.worker = worker_id
+    return timings
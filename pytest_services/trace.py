@@ -0,0 +1,60 @@
+"""Trace Event Format profiling of the service fixtures.
+
+The trace can be loaded into Perfetto or chrome://tracing, every worker is shown as a separate thread.
+"""
+import contextlib
+import json
+import time
+
+# The tracer of the test session, None if the tracing is not enabled.
+tracer = None
+
+
+class Tracer(object):
+
+    """Collector of the trace events."""
+
+    def __init__(self, worker='local', tid=0):
+        """Initialize the events.
+
+        :param worker: id of the worker
+        :param tid: thread id of the worker in the trace, eg. 4 for `gw3` and 0 for `local`
+        """
+        self.worker = worker
+        self.tid = tid
+        self.events = [dict(
+            name='thread_name', ph='M', pid=1, tid=tid, args=dict(name=worker),
+        )]
+
+    @contextlib.contextmanager
+    def span(self, event_name, category, **args):
+        """Record the complete event spanning the context."""
+        start = time.monotonic()
+        try:
+            yield args
+        finally:
+            self.events.append(dict(
+                name=event_name,
+                cat=category,
+                ph='X',
+                ts=start * 1e6,
+                dur=(time.monotonic() - start) * 1e6,
+                pid=1,
+                tid=self.tid,
+                args=args,
+            ))
+
+    def dump(self, path):
+        """Write the events to the JSON file."""
+        with open(path, 'w') as fd:
+            json.dump(dict(traceEvents=self.events, displayTimeUnit='ms'), fd)
+
+
+def span(event_name, category, **args):
+    """Trace the context if the tracing is enabled.
+
+    The context value is the dict of the event arguments, which can be updated within the context.
+    """
+    if tracer is None:
+        return contextlib.nullcontext(args)
+    return tracer.span(event_name, category, **args)
@@ -1,23 +1,33 @@
 """Fixtures for the GUI environment."""
 import os
-import socket
 import re
+import threading
 try:
     import subprocess32 as subprocess
 except ImportError:  # pragma: no cover
     import subprocess
 
+import psutil
 import pytest
+try:
+    import Xlib.display
+    import Xlib.error
+except ImportError:  # pragma: no cover
+    Xlib = None
 
+from .broker import ensure_broker, get_broker_socket, lease_service, prewarm_service
+from .checkers import DisplayFD, TCPConnect
 from .locks import (
     file_lock,
 )
+from .probes import which
+from .service import wait_for_service, worker_index
 
 
-def xvfb_supports_listen():
+def xvfb_supports_listen(executable='Xvfb'):
     """Determine whether the '-listen' option is supported by Xvfb."""
     p = subprocess.Popen(
-        ['Xvfb', '-listen', 'TCP', '-__sentinel_parameter__'],
+        [executable, '-listen', 'TCP', '-__sentinel_parameter__'],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
@@ -33,6 +43,138 @@ def xvfb_supports_listen():
     return unrecognized_option != b'-listen'
 
 
+def xvfb_arguments(display, resolution, listen_args, nolock=True):
+    """Xvfb command line arguments.
+
+    :param display: the display, None if the X server chooses it itself (`-displayfd`)
+    """
+    return ([':{display}'.format(display=display)] if display is not None else []) + [
+        '-screen',
+        '0',
+        'x'.join(str(value) for value in resolution),
+        '-ac',
+    ] + (['-nolock'] if nolock else []) + [
+        '+extension', 'RANDR'
+    ] + listen_args
+
+
+def kill_x_clients(display, exclude=()):
+    """Disconnect the clients of the display, so Xvfb resets the screen when the last one disconnects.
+
+    With python-xlib installed the X server kills the clients owning the top-level windows, like `xkill -all`,
+    including the ones which were reparented away from the test session, eg. daemonized browsers.
+    The descendants of the test session with the display in their environment are killed as well, except the
+    detached services in their own session, eg. the shared mysqld, which outlive the test session.
+
+    :param exclude: pids of the processes which should not be killed, eg. the X server
+    """
+    name = ':{0}'.format(display)
+    if Xlib is not None:
+        try:
+            connection = Xlib.display.Display(name)
+        except (Xlib.error.DisplayError, OSError):
+            connection = None
+        if connection is not None:
+            try:
+                for window in connection.screen().root.query_tree().children:
+                    connection.kill_client(window.id)
+                connection.sync()
+            except Xlib.error.XError:
+                pass
+            finally:
+                connection.close()
+
+    session = os.getsid(0)
+    for process in psutil.Process().children(recursive=True):
+        if process.pid in exclude:
+            continue
+        try:
+            if os.getsid(process.pid) == session and process.environ().get('DISPLAY') in (name, name + '.0'):
+                process.kill()
+        except (OSError, psutil.Error):
+            pass
+
+
+@pytest.fixture(scope='session')
+def xvfb_pool_lease(
+        request, memory_root_dir, lock_dir, services_log, xvfb_resolution, services_probes, watcher_poll_schedule,
+        worker_id):
+    """Lease of the pre-warmed Xvfb of the pool, see `--xvfb-pool`.
+
+    None if the pool is not enabled or all its displays are leased by the other sessions, or fail to start.
+    The clients of the display are killed when the lease ends, see `kill_x_clients`.
+    """
+    size = request.config.option.xvfb_pool
+    if not size:
+        return None
+    broker = get_broker_socket(memory_root_dir)
+    ensure_broker(broker, lock_dir, request.config.option.services_broker_idle_timeout, services_log)
+    executable = which('Xvfb')
+    assert executable, 'You have to install Xvfb executable.'
+    listen_args = ['-listen', 'TCP'] if services_probes.probe('Xvfb', 'supports_listen', xvfb_supports_listen) else []
+
+    def get_cmd(display):
+        # the pool servers create the lock files, so the displays are not allocated by the display_getter
+        return [executable] + xvfb_arguments(display, xvfb_resolution, listen_args, nolock=False)
+
+    first = request.config.option.xvfb_pool_display
+    offset = worker_index(worker_id) % size
+    displays = [first + (offset + index) % size for index in range(size)]
+    for display in displays:
+        lease = lease_service(broker, get_cmd(display))
+        if lease is None:
+            services_log.debug('Pool Xvfb :{0} is leased by another session'.format(display))
+            continue
+        try:
+            wait_for_service('Xvfb', lease, TCPConnect('127.0.0.1', 6000 + display), 20, watcher_poll_schedule)
+        except Exception as err:
+            # eg. the display is used by an X server of another user
+            services_log.debug('Pool Xvfb :{0} did not start: {1}'.format(display, err))
+            lease.terminate()
+            continue
+        services_log.debug('Leased {0} pool Xvfb :{1}'.format('warm' if lease.warm else 'cold', display))
+        lease.display = display
+
+        def finalize():
+            kill_x_clients(display, exclude=[lease.pid])
+            lease.terminate()
+        request.addfinalizer(finalize)
+
+        def prewarm():
+            for other in displays:
+                if other != display:
+                    try:
+                        prewarm_service(broker, get_cmd(other))
+                    except OSError:
+                        return
+        threading.Thread(target=prewarm, daemon=True).start()
+        return lease
+    return None
+
+
+@pytest.fixture(scope='session')
+def xvfb_displayfd(request, xvfb_resolution, watcher_getter):
+    """The Xvfb process started with `-displayfd`, see `--xvfb-displayfd`.
+
+    Xvfb chooses a free display itself and writes it to the pipe when it is ready, the display is assigned to the
+    `display` attribute of the process. The clients connect over the unix socket, Xvfb doesn't listen on TCP.
+    """
+    read_fd, write_fd = os.pipe()
+    request.addfinalizer(lambda: os.close(read_fd))
+    checker = DisplayFD(read_fd)
+    try:
+        watcher = watcher_getter(
+            'Xvfb', xvfb_arguments(None, xvfb_resolution, ['-displayfd', str(write_fd)], nolock=False),
+            kwargs=dict(pass_fds=[write_fd]),
+            checker=checker,
+            request=request,
+        )
+    finally:
+        os.close(write_fd)
+    watcher.display = checker.display
+    return watcher
+
+
 @pytest.fixture(scope='session')
 def xvfb_display(request, run_services, lock_dir, services_log, display_getter):
     """The DISPLAY environment variable used in this test run.
@@ -40,12 +182,20 @@ def xvfb_display(request, run_services, lock_dir, services_log, display_getter):
     In case it is not a local run, a random value will be picked up and set,
     otherwise it will be taken from the environment.
 
+    With `--xvfb-pool` the display of the leased pool Xvfb is used, with `--xvfb-displayfd` the display chosen
+    by the started Xvfb.
     """
     if run_services:
         if request.config.option.display:
             display = request.config.option.display
         else:
-            display = display_getter()
+            lease = request.getfixturevalue('xvfb_pool_lease') if request.config.option.xvfb_pool else None
+            if lease is not None:
+                display = lease.display
+            elif request.config.option.xvfb_displayfd:
+                display = request.getfixturevalue('xvfb_displayfd').display
+            else:
+                display = display_getter()
         os.environ['DISPLAY'] = ':{0}'.format(display) if ':' not in str(display) else display
 
         return display
@@ -58,37 +208,28 @@ def xvfb_resolution():
 
 
 @pytest.fixture(scope='session')
-def xvfb(request, run_services, xvfb_display, lock_dir, xvfb_resolution, watcher_getter):
+def xvfb(request, run_services, xvfb_display, lock_dir, xvfb_resolution, watcher_getter, services_probes):
     """The Xvfb process."""
     if request.config.option.display or not run_services:
         # display is passed, no action required
         return
 
-    if xvfb_supports_listen():
+    lease = request.getfixturevalue('xvfb_pool_lease') if request.config.option.xvfb_pool else None
+    if lease is not None:
+        return lease
+
+    if request.config.option.xvfb_displayfd:
+        return request.getfixturevalue('xvfb_displayfd')
+
+    if services_probes.probe('Xvfb', 'supports_listen', xvfb_supports_listen):
         listen_args = ['-listen', 'TCP']
     else:
         listen_args = []
 
     with file_lock(os.path.join(lock_dir, 'xvfb_{0}.lock'.format(xvfb_display)),
                    ):
-
-        def checker():
-            try:
-                socket.create_connection(('127.0.0.1', 6000 + xvfb_display))
-                return True
-            except socket.error:
-                pass
-
         return watcher_getter(
-            'Xvfb', [
-                ':{display}'.format(display=xvfb_display),
-                '-screen',
-                '0',
-                'x'.join(str(value) for value in xvfb_resolution),
-                '-ac',
-                '-nolock',
-                '+extension', 'RANDR'
-            ] + listen_args,
-            checker=checker,
+            'Xvfb', xvfb_arguments(xvfb_display, xvfb_resolution, listen_args),
+            checker=TCPConnect('127.0.0.1', 6000 + xvfb_display),
             request=request,
         )
@@ -29,6 +29,7 @@ setup(
     url='https://github.com/pytest-dev/pytest-services',
     extras={
         'memcached': ['pylibmc'],
+        'xvfb': ['python-xlib'],
     },
     python_requires=">=3.9",
     install_requires=install_requires,
@@ -0,0 +1,219 @@
+"""Tests for the resource allocators."""
+import json
+import os
+import socket
+import sys
+try:
+    import subprocess32 as subprocess
+except ImportError:  # pragma: no cover
+    import subprocess
+
+import pytest
+
+from pytest_services.allocators import ByteRangeAllocator, DaemonAllocator, PartitionAllocator, RegistryAllocator
+from pytest_services.broker import wait_for_broker
+from pytest_services.locks import (
+    free_port_checker,
+    gc_locks,
+    locked_resources,
+    owner_entry,
+    port_free,
+    resource_value,
+    used_ports,
+)
+
+
+@pytest.fixture
+def allocator_server(tmp_path):
+    """Socket of the running allocator daemon."""
+    path = str(tmp_path / 'allocator.sock')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'pytest_services.allocator_server', '--socket', path, '--idle-timeout', '60'])
+    assert wait_for_broker(path, 10)
+    yield path
+    process.terminate()
+    process.wait(10)
+
+
+def test_allocator_server_socket_shared(allocator_server):
+    """Test that the allocator socket is connectable by the other users sharing the host."""
+    assert os.stat(allocator_server).st_mode & 0o777 == 0o666
+
+
+@pytest.fixture(params=['registry', 'fcntl', 'daemon'])
+def allocator(request, tmp_path, services_log):
+    """Allocator using the temporary lock dir."""
+    if request.param == 'fcntl':
+        return ByteRangeAllocator(str(tmp_path), services_log)
+    if request.param == 'daemon':
+        allocator = DaemonAllocator(request.getfixturevalue('allocator_server'), services_log)
+        request.addfinalizer(allocator.close)
+        return allocator
+    return RegistryAllocator(str(tmp_path), services_log, 20)
+
+
+def test_allocate_release(allocator):
+    """Test that the allocated resources are distinct and the released ones are allocated again."""
+    def is_free(resource):
+        return resource != 11
+
+    first = allocator.allocate('resource', 10, is_free)
+    second = allocator.allocate('resource', 10, is_free)
+    assert (first, second) == (10, 12)
+    allocator.release('resource', second)
+    assert allocator.allocate('resource', 10, is_free) == 12
+
+
+def test_allocate_many(allocator):
+    """Test that the contiguous block skips the used resources and is released at once."""
+    def is_free(resource):
+        return resource != 12
+
+    assert allocator.allocate_many('resource', 10, is_free, 3) == [10, 11, 13]
+    assert allocator.allocate_many('resource', 10, is_free, 3, contiguous=True) == [14, 15, 16]
+    allocator.release('resource', 10, 11, 13, 14, 15, 16)
+    assert allocator.allocate_many('resource', 10, is_free, 2, contiguous=True) == [10, 11]
+
+
+def test_allocate_range(allocator):
+    """Test that the lowest released resources are reused and the resources stay within the range."""
+    assert allocator.allocate_many('resource', 10, lambda resource: True, 3, end=13) == [10, 11, 12]
+    with pytest.raises(Exception):
+        allocator.allocate('resource', 10, lambda resource: True, end=13)
+    allocator.release('resource', 11)
+    assert allocator.allocate('resource', 10, lambda resource: True, end=13) == 11
+
+
+def test_allocate_port(allocator):
+    """Test the port allocation."""
+    port = allocator.allocate('port', 30000, port_free)
+    assert port_free(port)
+    allocator.release('port', port)
+
+
+def test_used_ports():
+    """Test that the ports of the listening sockets are read from the kernel tables."""
+    if not os.path.exists('/proc/net/tcp'):
+        pytest.skip('/proc/net/tcp is not available')
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1)
+    with sock:
+        port = sock.getsockname()[1]
+        assert port in used_ports()
+        assert not free_port_checker()(port)
+
+
+def test_byte_range_released_on_exit(tmp_path, services_log):
+    """Test that the resources of the process are released by the kernel when it exits."""
+    code = (
+        'import logging, sys; from pytest_services.allocators import ByteRangeAllocator; '
+        'allocator = ByteRangeAllocator(sys.argv[1], logging.getLogger()); '
+        'print(allocator.allocate("resource", 10, lambda resource: True)); sys.stdout.flush(); sys.stdin.read()'
+    )
+    process = subprocess.Popen(
+        [sys.executable, '-c', code, str(tmp_path)], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert process.stdout.readline().strip() == b'10'
+
+    allocator = ByteRangeAllocator(str(tmp_path), services_log)
+    assert allocator.allocate('resource', 10, lambda resource: True) == 11
+    process.communicate()
+    assert allocator.allocate('resource', 10, lambda resource: True) == 10
+
+
+def test_daemon_releases_on_disconnect(allocator_server, services_log):
+    """Test that the resources of the closed connection are released."""
+    first = DaemonAllocator(allocator_server, services_log)
+    assert first.allocate_many('resource', 10, lambda resource: True, 2) == [10, 11]
+    second = DaemonAllocator(allocator_server, services_log)
+    assert second.allocate('resource', 10, lambda resource: True) == 12
+    first.close()
+    assert second.allocate_many('resource', 10, lambda resource: True, 2) == [10, 11]
+    second.close()
+
+
+def test_registry_reclaims_dead_owners(tmp_path, services_log):
+    """Test that the resources of the dead owners are reclaimed on allocation."""
+    process = subprocess.Popen(['true'])
+    process.wait()
+    with locked_resources('resource', str(tmp_path)) as registry:
+        registry.append(dict(owner_entry(10), pid=process.pid))
+        registry.append(11)
+
+    allocator = RegistryAllocator(str(tmp_path), services_log, 20, 'session')
+    assert allocator.allocate('resource', 10, lambda resource: True) == 10
+    with locked_resources('resource', str(tmp_path)) as registry:
+        assert [resource_value(entry) for entry in registry] == [11, 10]
+        assert registry[1]['pid'] == os.getpid()
+        assert registry[1]['session'] == 'session'
+
+
+def test_registry_readable_by_older_releases(tmp_path, services_log):
+    """Test that the shared resource list keeps the bare resources read and written by the older releases."""
+    allocator = RegistryAllocator(str(tmp_path), services_log, 20, 'session')
+    assert allocator.allocate_many('resource', 10, lambda resource: True, 2) == [10, 11]
+    with open(str(tmp_path / 'resource')) as fd:
+        bound_resources = json.load(fd)
+    assert bound_resources == [10, 11]
+
+    # an older release binds the next resource and releases one of ours
+    bound_resources.append(max(bound_resources) + 1)
+    bound_resources.remove(10)
+    with open(str(tmp_path / 'resource'), 'w') as fd:
+        json.dump(bound_resources, fd)
+
+    with locked_resources('resource', str(tmp_path)) as registry:
+        assert registry[0]['resource'] == 11
+        assert registry[1] == 12
+    with open(str(tmp_path / 'resource.owners')) as fd:
+        assert [entry['resource'] for entry in json.load(fd)] == [11]
+
+
+def test_gc_locks(tmp_path, services_log):
+    """Test that the registries are compacted by the garbage collector."""
+    with locked_resources('resource', str(tmp_path)) as registry:
+        registry.extend([10, owner_entry(11), dict(owner_entry(12), started=0)])
+    with locked_resources('mysql-shared', str(tmp_path)) as sessions:
+        sessions.append('session')
+
+    removed = gc_locks(str(tmp_path), services_log)
+    assert {name: [resource_value(entry) for entry in entries] for name, entries in removed.items()} == {
+        'resource': [10, 12]}
+    with locked_resources('resource', str(tmp_path)) as registry:
+        assert [resource_value(entry) for entry in registry] == [11]
+    with locked_resources('mysql-shared', str(tmp_path)) as sessions:
+        assert sessions == ['session']
+
+
+def test_gc_locks_command(pytester, tmp_path):
+    """Test that the registries of the given lock dir are compacted by the command line option."""
+    lock_dir = tmp_path / 'locks'
+    lock_dir.mkdir()
+    with locked_resources('resource', str(lock_dir)) as registry:
+        registry.extend([10, owner_entry(11)])
+    result = pytester.runpytest('--services-gc-locks={0}'.format(lock_dir))
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*resource: 1 entries removed'])
+    with locked_resources('resource', str(lock_dir)) as registry:
+        assert [resource_value(entry) for entry in registry] == [11]
+
+
+def test_partition_allocator(tmp_path, services_log):
+    """Test that the workers allocate from the disjoint slices and fall back to the shared allocator."""
+    def partition_allocator(worker_id):
+        shared = RegistryAllocator(str(tmp_path), services_log, 20)
+        return PartitionAllocator(
+            shared, str(tmp_path), services_log, 20, worker_id, port_range=(20000, 20006), size=3)
+
+    first, second = partition_allocator('gw1'), partition_allocator('gw1')
+    assert first.allocate('port', 30000, lambda port: port != 20004) == 20003
+    assert second.allocate_many('port', 30000, lambda port: True, 3) == [20000, 20001, 20002]
+    assert first.allocate('port', 30000, lambda port: port != 20004) == 20005
+    assert first.allocate('port', 30000, lambda port: port != 20004) == 30000
+    first.release('port', 20003, 30000)
+    assert first.allocate('port', 30000, lambda port: True) == 20003
+
+    first.close()
+    third = partition_allocator('gw1')
+    assert third.allocate('port', 30000, lambda port: True) == 20003
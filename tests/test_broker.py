@@ -0,0 +1,92 @@
+"""Tests for the persistent service broker."""
+import os
+import socket
+import sys
+try:
+    import subprocess32 as subprocess
+except ImportError:  # pragma: no cover
+    import subprocess
+
+import psutil
+import pytest
+
+from pytest_services.broker import lease_service, peer_uid, prewarm_service, service_key, wait_for_broker
+
+
+@pytest.fixture
+def broker(tmp_path):
+    """Running service broker."""
+    path = str(tmp_path / 'broker.sock')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'pytest_services.broker', '--socket', path, '--idle-timeout', '60'])
+    assert wait_for_broker(path, 10)
+    yield path
+    process.terminate()
+    process.wait(10)
+
+
+def test_lease_reuses_warm_service(broker):
+    """Test that the released service is reused by the next lease."""
+    sleep = subprocess.check_output(['which', 'sleep']).decode().strip()
+    lease = lease_service(broker, [sleep, '60'])
+    assert not lease.warm
+    assert lease.poll() is None
+    assert lease_service(broker, [sleep, '60']) is None
+    lease.terminate()
+
+    lease = lease_service(broker, [sleep, '60'])
+    try:
+        assert lease.warm
+        assert lease.poll() is None
+        pid = lease.pid
+    finally:
+        lease.terminate()
+
+    other = lease_service(broker, [sleep, '61'])
+    assert other.pid != pid
+    other.terminate()
+
+
+def test_prewarm_service(broker):
+    """Test that the prewarmed service is started and released for the next lease."""
+    sleep = subprocess.check_output(['which', 'sleep']).decode().strip()
+    assert prewarm_service(broker, [sleep, '60'])
+    lease = lease_service(broker, [sleep, '60'])
+    try:
+        assert lease.warm
+        assert not prewarm_service(broker, [sleep, '60'])
+    finally:
+        lease.terminate()
+
+
+def test_broker_stops_services(tmp_path):
+    """Test that the services are stopped together with the broker."""
+    path = str(tmp_path / 'broker.sock')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'pytest_services.broker', '--socket', path, '--idle-timeout', '60'])
+    assert wait_for_broker(path, 10)
+    lease = lease_service(path, ['/bin/sh', '-c', 'sleep 60'])
+    lease.terminate()
+    process.terminate()
+    process.wait(10)
+    assert not psutil.pid_exists(lease.pid)
+    assert not os.path.exists(path)
+
+
+def test_service_key_defaults_file(tmp_path):
+    """Test that the service key depends on the contents of the defaults file."""
+    defaults = tmp_path / 'defaults.cnf'
+    defaults.write_text('[mysqld]\n')
+    cmd = ['mysqld', '--defaults-file={0}'.format(defaults)]
+    key = service_key(cmd)
+    assert service_key(cmd) == key
+    defaults.write_text('[mysqld]\nuser = test\n')
+    assert service_key(cmd) != key
+
+
+def test_broker_socket_private(broker):
+    """Test that the broker socket is accessible only by its user, who is the peer of the connection."""
+    assert os.stat(broker).st_mode & 0o777 == 0o600
+    left, right = socket.socketpair()
+    with left, right:
+        assert peer_uid(left) in (os.getuid(), None)
@@ -0,0 +1,224 @@
+"""Tests for service readiness checkers."""
+import contextlib
+import http.server
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from pytest_services.checkers import (
+    Checker,
+    DisplayFD,
+    HTTPGet,
+    MemcachedVersion,
+    MySQLHandshake,
+    PathExists,
+    TCPConnect,
+    UnixSocketConnect,
+)
+
+
+def test_checker_is_abstract():
+    """Test that the base checker can't be instantiated without the check."""
+    with pytest.raises(TypeError):
+        Checker()
+
+
+def test_path_exists_wait(tmp_path):
+    """Test that waiting for a path wakes up as soon as the path is created."""
+    path = tmp_path / 'service.sock'
+    checker = PathExists(str(path))
+    assert not checker()
+
+    timer = threading.Timer(0.05, path.touch)
+    timer.start()
+    start = time.monotonic()
+    assert checker.wait(5)
+    assert time.monotonic() - start < 1
+    timer.join()
+
+
+def test_path_exists_wait_timeout(tmp_path):
+    """Test that waiting for a path which is not created times out."""
+    assert not PathExists(str(tmp_path / 'missing.sock')).wait(0.05)
+
+
+def test_path_exists_poll(tmp_path):
+    """Test the polling fallback."""
+    path = tmp_path / 'service.pid'
+    checker = PathExists(str(path))
+    assert not checker.poll(time.monotonic() + 0.05)
+    path.touch()
+    assert checker.poll(time.monotonic())
+
+
+def test_watcher_getter_path_checker(request, watcher_getter, tmp_path):
+    """Test that the watcher getter waits for the path checker."""
+    path = os.path.join(str(tmp_path), 'service.sock')
+    watcher = watcher_getter(
+        'sh', ['-c', 'sleep 0.1 && touch {0} && sleep 10'.format(path)],
+        checker=PathExists(path),
+        request=request,
+    )
+    assert os.path.exists(path)
+    assert watcher.startup_duration < 1
+
+
+def test_watcher_getter_displayfd_checker(request, watcher_getter):
+    """Test that the watcher getter waits for the display number written to the pipe."""
+    read_fd, write_fd = os.pipe()
+    checker = DisplayFD(read_fd)
+    try:
+        watcher_getter(
+            'sh', ['-c', 'sleep 0.1 && echo 42 > /dev/fd/{0} && sleep 10'.format(write_fd)],
+            kwargs=dict(pass_fds=[write_fd]),
+            checker=checker,
+            request=request,
+        )
+        assert checker.display == 42
+        assert checker()
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_displayfd_timeout():
+    """Test that the display checker fails when nothing is written to the pipe."""
+    read_fd, write_fd = os.pipe()
+    try:
+        os.write(write_fd, b'4')
+        checker = DisplayFD(read_fd)
+        assert not checker.wait(0.01)
+        assert checker.display is None
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+@contextlib.contextmanager
+def serve(sock, respond):
+    """Accept the connections on the listening socket in a thread, calling respond for each."""
+    sock.listen(5)
+
+    def accept():
+        while True:
+            try:
+                connection, _ = sock.accept()
+            except OSError:
+                return
+            with contextlib.closing(connection):
+                respond(connection)
+
+    thread = threading.Thread(target=accept, daemon=True)
+    thread.start()
+    try:
+        yield sock
+    finally:
+        sock.shutdown(socket.SHUT_RDWR)
+        sock.close()
+        thread.join()
+
+
+@pytest.fixture
+def tcp_socket():
+    """Bound TCP socket."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    return sock
+
+
+def test_tcp_connect(tcp_socket):
+    """Test the TCP connect checker."""
+    checker = TCPConnect(*tcp_socket.getsockname())
+    assert not checker()
+    with serve(tcp_socket, lambda connection: None):
+        assert checker()
+        assert checker.wait(1)
+
+
+def test_unix_socket_connect(tmp_path):
+    """Test that the unix socket connect checker waits for the socket to accept connections."""
+    path = str(tmp_path / 'service.sock')
+    checker = UnixSocketConnect(path)
+    assert not checker()
+    assert not checker.wait(0.05)
+
+    sock = socket.socket(socket.AF_UNIX)
+    sock.bind(path)
+    # the socket file exists, but the service doesn't listen yet
+    assert not checker()
+    timer = threading.Timer(0.05, sock.listen)
+    timer.start()
+    assert checker.wait(5)
+    timer.join()
+    sock.close()
+
+
+def test_memcached_version(tmp_path):
+    """Test the memcached version checker."""
+    path = str(tmp_path / 'memcached.sock')
+    sock = socket.socket(socket.AF_UNIX)
+    sock.bind(path)
+
+    def respond(connection):
+        if connection.recv(1024) == b'version\r\n':
+            connection.sendall(b'VERSION 1.6.21\r\n')
+
+    with serve(sock, respond):
+        assert MemcachedVersion(path)()
+
+
+def test_memcached_version_error(tcp_socket):
+    """Test that the memcached version checker fails on unexpected response."""
+    def respond(connection):
+        connection.recv(1024)
+        connection.sendall(b'SERVER_ERROR out of memory\r\n')
+
+    with serve(tcp_socket, respond):
+        assert not MemcachedVersion(tcp_socket.getsockname())()
+
+
+def test_mysql_handshake(tcp_socket):
+    """Test the MySQL handshake checker."""
+    def respond(connection):
+        payload = b'\x0a8.0.35\x00' + b'\x00' * 40
+        connection.sendall(len(payload).to_bytes(3, 'little') + b'\x00' + payload)
+
+    checker = MySQLHandshake(tcp_socket.getsockname())
+    with serve(tcp_socket, respond):
+        assert checker()
+
+
+def test_mysql_handshake_error(tcp_socket):
+    """Test that the MySQL error packet is not taken for the ready server."""
+    def respond(connection):
+        payload = b'\xff\x10\x04Too many connections'
+        connection.sendall(len(payload).to_bytes(3, 'little') + b'\x00' + payload)
+
+    with serve(tcp_socket, respond):
+        assert not MySQLHandshake(tcp_socket.getsockname())()
+
+
+def test_http_get():
+    """Test the HTTP GET checker."""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200 if self.path == '/health' else 503)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:{0}'.format(server.server_port)
+        assert HTTPGet(url + '/health')()
+        assert not HTTPGet(url + '/')()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert not HTTPGet(url + '/health')()
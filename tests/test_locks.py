@@ -0,0 +1,94 @@
+"""Tests for the inter-process locks."""
+import json
+import os
+import sys
+import threading
+import time
+try:
+    import subprocess32 as subprocess
+except ImportError:  # pragma: no cover
+    import subprocess
+
+import pytest
+import zc.lockfile
+
+from pytest_services.locks import file_lock
+
+
+def hold_lock(path, seconds, remove=False):
+    """Hold the lock of the file in a thread for the given number of seconds."""
+    locked = threading.Event()
+
+    def hold():
+        with file_lock(path, remove=remove):
+            locked.set()
+            time.sleep(seconds)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    locked.wait()
+    return thread
+
+
+def test_file_lock_handoff(tmp_path):
+    """Test that the waiter gets the lock as soon as it's released."""
+    path = str(tmp_path / 'lock')
+    holder = hold_lock(path, 0.3)
+    start = time.monotonic()
+    with file_lock(path, remove=False):
+        waited = time.monotonic() - start
+    holder.join()
+    assert 0.25 < waited < 1
+
+
+def test_file_lock_timeout(tmp_path):
+    """Test that the lock is not acquired after the timeout and released by the abandoned waiter."""
+    path = str(tmp_path / 'lock')
+    holder = hold_lock(path, 1)
+    with pytest.raises(zc.lockfile.LockError):
+        with file_lock(path, timeout=0.1):
+            pass
+    # gave up while the lock was still held
+    assert holder.is_alive()
+    holder.join()
+    with file_lock(path, timeout=0.1):
+        pass
+
+
+def test_file_lock_removed(tmp_path):
+    """Test that the lock of the file removed by its previous holder is acquired again."""
+    path = str(tmp_path / 'lock')
+    holder = hold_lock(path, 0.2, remove=True)
+    with file_lock(path, remove=False):
+        assert os.path.exists(path)
+        with pytest.raises(zc.lockfile.LockError):
+            zc.lockfile.SimpleLockFile(path)
+    holder.join()
+
+
+def test_file_lock_shared(tmp_path):
+    """Test that the shared locks don't exclude each other and exclude the exclusive lock."""
+    path = str(tmp_path / 'lock')
+    with file_lock(path, remove=False, shared=True):
+        with file_lock(path, remove=False, timeout=0.1, shared=True):
+            with pytest.raises(zc.lockfile.LockError):
+                with file_lock(path, remove=False, timeout=0.1):
+                    pass
+    with file_lock(path, remove=False, timeout=0.1):
+        with pytest.raises(zc.lockfile.LockError):
+            with file_lock(path, remove=False, timeout=0.1, shared=True):
+                pass
+
+
+def test_benchmark(tmp_path):
+    """Test that the locking benchmark reports every operation."""
+    root = os.path.dirname(os.path.dirname(__file__))
+    output = str(tmp_path / 'results.json')
+    subprocess.check_call([
+        sys.executable, os.path.join(root, 'benchmarks', 'locks.py'),
+        '--processes', '2', '--iterations', '2', '--output', output,
+    ], cwd=root)
+    with open(output) as fd:
+        results = json.load(fd)
+    assert [(result['operation'], result['count'], result['timeout_rate']) for result in results] == [
+        ('file_lock', 4, 0.0), ('get_free_port', 4, 0.0), ('get_free_display', 4, 0.0), ('unlock_resource', 4, 0.0)]
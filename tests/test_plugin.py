@@ -1,6 +1,28 @@
 """Tests for pytest-services plugin."""
+import asyncio
+import json
 import os.path
 import socket
+import sys
+import time
+
+import psutil
+import pytest
+
+from pytest_services.contention import LockContention, aggregate
+from pytest_services.locks import file_lock, owner_entry
+from pytest_services.mysql import (
+    clone_tree,
+    leave_shared_mysql,
+    mysql_template_lock,
+    normalized_mysql_defaults,
+    prune_mysql_templates,
+    running_mysql,
+    stop_mysql,
+    write_mysql_defaults_file,
+    zoneinfo_fingerprint,
+)
+from pytest_services.teardown import ServicesTeardown
 
 
 def test_memcached(request, memcached, memcached_socket):
@@ -42,6 +64,64 @@ def test_port_getter(port_getter):
     assert port1 != port2
 
 
+def test_port_getter_count(port_getter):
+    """Test that the contiguous block of ports is locked at once."""
+    ports = port_getter(count=5, contiguous=True)
+    assert ports == list(range(ports[0], ports[0] + 5))
+    assert port_getter() not in ports
+
+
+SOCKET_ACTIVATED_SERVICE = """
+import os, socket, sys
+assert os.environ['LISTEN_PID'] == str(os.getpid())
+for fd in sys.argv[1:]:
+    try:
+        os.fstat(int(fd))
+    except OSError:
+        pass
+    else:
+        raise AssertionError('descriptor {0} was leaked'.format(fd))
+sock = socket.socket(fileno=3)
+for _ in range(int(os.environ['LISTEN_FDS'])):
+    connection, _ = sock.accept()
+    connection.sendall(b'hello')
+    connection.close()
+"""
+
+
+def test_socket_activation(request, watcher_getter, socket_getter):
+    """Test that the listening socket is passed to the service, the other descriptors are not."""
+    sock = socket_getter()
+    port = sock.getsockname()[1]
+    read_fd, write_fd = os.pipe()
+    os.set_inheritable(write_fd, True)
+    # the original descriptor of the socket is not left open either
+    leaked = [str(fd) for fd in (write_fd, sock.fileno()) if fd != 3]
+    try:
+        watcher = watcher_getter(
+            sys.executable, ['-c', SOCKET_ACTIVATED_SERVICE] + leaked, checker=lambda: True, request=request,
+            sockets=[sock])
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as connection:
+            assert connection.recv(5) == b'hello'
+        watcher.wait(5)
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+    assert watcher.returncode == 0
+
+
+def test_socket_closed_late(request, watcher_getter, socket_getter):
+    """Test that the socket is closed before the service which can't accept it is started."""
+    sock = socket_getter()
+    port = sock.getsockname()[1]
+    watcher = watcher_getter(
+        sys.executable, ['-c', 'import socket; socket.socket().bind(("127.0.0.1", {0}))'.format(port)],
+        checker=lambda: True, request=request, sockets=[sock], pass_sockets=False)
+    assert sock.fileno() == -1
+    watcher.wait(5)
+    assert watcher.returncode == 0
+
+
 def test_display_getter(display_getter):
     """Test display getter utility."""
     display1 = display_getter()
@@ -54,3 +134,318 @@ def test_display_getter(display_getter):
 def test_temp_dir(temp_dir):
     """Test temp dir directory."""
     assert os.path.isdir(temp_dir)
+
+
+def test_watcher_getter_ready_without_full_second_sleep(request, watcher_getter):
+    """Test that the watcher is returned as soon as the checker succeeds."""
+    attempts = []
+
+    def checker():
+        attempts.append(None)
+        return len(attempts) > 3
+
+    watcher = watcher_getter('sleep', ['10'], checker=checker, request=request)
+    assert watcher.poll() is None
+    assert watcher.startup_duration < 1
+
+
+def test_watcher_getter_timeout_is_wall_clock(request, watcher_getter):
+    """Test that the watcher timeout is measured in seconds, not in checker attempts."""
+    with pytest.raises(Exception, match='did not succeed'):
+        watcher_getter('sleep', ['10'], timeout=0.2, checker=lambda: False, request=request)
+
+
+def test_watcher_getter_start_many(request, watcher_getter):
+    """Test that several services are waited for concurrently."""
+    first_checks, ready = [], []
+
+    def slow_checker():
+        checks = []
+
+        def check():
+            if not checks:
+                first_checks.append(time.monotonic())
+            checks.append(time.monotonic())
+            if checks[-1] - checks[0] > 0.3:
+                ready.append(time.monotonic())
+                return True
+            return False
+        return check
+
+    watchers = watcher_getter.start_many([
+        dict(name='sleep', arguments=['10'], checker=slow_checker()),
+        dict(name='sleep', arguments=['10'], checker=slow_checker()),
+    ], request=request)
+    # the second service is checked before the first one is ready
+    assert max(first_checks) < min(ready)
+    assert len(watchers) == 2
+    assert all(watcher.poll() is None for watcher in watchers)
+
+
+def test_async_watcher_getter(request, async_watcher_getter):
+    """Test the asyncio variant of the watcher getter."""
+    attempts = []
+
+    async def checker():
+        attempts.append(None)
+        return len(attempts) > 2
+
+    async def start_and_stop():
+        watcher = await async_watcher_getter('sleep', ['10'], checker=checker, request=request)
+        assert watcher.returncode is None
+        await watcher.stop()
+        return watcher
+
+    watcher = asyncio.run(start_and_stop())
+    assert watcher.returncode is not None
+    assert watcher.startup_duration < 1
+
+
+def test_async_watcher_getter_finalizer(request, async_watcher_getter):
+    """Test that the service is stopped by the finalizer after the event loop is closed."""
+    watchers = []
+    request.addfinalizer(lambda: assert_stopped(watchers[0].pid))
+    watchers.append(asyncio.run(async_watcher_getter('sleep', ['10'], checker=lambda: True, request=request)))
+
+
+def assert_stopped(pid):
+    """Assert that the process is not running."""
+    assert not psutil.pid_exists(pid) or psutil.Process(pid).status() == psutil.STATUS_ZOMBIE
+
+
+def test_running_mysql_stale_pid_file(tmp_path):
+    """Test that a stale pid file of the shared mysqld is not taken for a running server."""
+    pid_file = tmp_path / 'mysql.pid'
+    assert running_mysql(str(pid_file)) is None
+    pid_file.write_text(str(os.getpid()))
+    assert running_mysql(str(pid_file)) is None
+
+
+def test_leave_shared_mysql():
+    """Test that the session leaves the shared mysqld together with the sessions of the dead processes."""
+    process = psutil.Popen(['true'])
+    process.wait()
+    other = dict(owner_entry('other'), pid=process.pid)
+    alive = dict(owner_entry('alive'), pid=os.getppid(), started=psutil.Process(os.getppid()).create_time())
+    sessions = [owner_entry('session'), other, alive, 'legacy']
+    leave_shared_mysql(sessions, 'session')
+    assert sessions == [alive, 'legacy']
+
+
+def test_stop_mysql_of_another_user():
+    """Test that the mysqld which can't be stopped by this user is reported as running."""
+    class Process(object):
+        def terminate(self):
+            raise psutil.AccessDenied()
+
+    assert not stop_mysql(Process(), 1)
+
+
+def test_clone_tree(tmp_path):
+    """Test that the template tree is cloned into the existing data dir."""
+    template = tmp_path / 'template'
+    (template / 'mysql').mkdir(parents=True)
+    (template / 'ibdata1').write_bytes(b'data')
+    (template / 'mysql' / 'user.ibd').write_bytes(b'user')
+    data = tmp_path / 'data'
+    data.mkdir()
+    clone_tree(str(template), str(data))
+    assert (data / 'ibdata1').read_bytes() == b'data'
+    assert (data / 'mysql' / 'user.ibd').read_bytes() == b'user'
+    (data / 'ibdata1').write_bytes(b'changed')
+    assert (template / 'ibdata1').read_bytes() == b'data'
+
+
+def test_normalized_mysql_defaults(tmp_path, monkeypatch):
+    """Test that the per session tmpdir doesn't change the template key."""
+    monkeypatch.setenv('USER', 'test')
+    first, second = tmp_path / 'first.cnf', tmp_path / 'second.cnf'
+    write_mysql_defaults_file(str(first), '/tmp/first')
+    write_mysql_defaults_file(str(second), '/tmp/second')
+    assert normalized_mysql_defaults(str(first)) == normalized_mysql_defaults(str(second))
+    assert normalized_mysql_defaults(str(first)) == [
+        '[mysqld]', 'user = test', 'default-time-zone = SYSTEM']
+
+
+def test_prune_mysql_templates(tmp_path, services_log):
+    """Test that the unused templates of the other keys are removed, unless they are being cloned."""
+    templates, lock_dir = tmp_path / 'templates', tmp_path / 'locks'
+    lock_dir.mkdir()
+    for name in ('current', 'old', 'recent', 'cloned', 'current.123'):
+        (templates / name).mkdir(parents=True)
+        if name != 'recent':
+            os.utime(str(templates / name), (0, 0))
+    with file_lock(mysql_template_lock(str(lock_dir), 'cloned'), remove=False, shared=True):
+        prune_mysql_templates(str(templates), 'current', str(lock_dir), services_log)
+    assert sorted(os.listdir(str(templates))) == ['cloned', 'current', 'current.123', 'recent']
+
+
+def test_zoneinfo_fingerprint(tmp_path):
+    """Test that the fingerprint of the zoneinfo tree changes with its files."""
+    (tmp_path / 'Europe').mkdir()
+    (tmp_path / 'Europe' / 'Prague').write_bytes(b'TZif')
+    fingerprint = zoneinfo_fingerprint(str(tmp_path))
+    assert zoneinfo_fingerprint(str(tmp_path)) == fingerprint
+    (tmp_path / 'UTC').write_bytes(b'TZif')
+    assert zoneinfo_fingerprint(str(tmp_path)) != fingerprint
+
+
+def test_services_timings(pytester):
+    """Test the services timings summary and file."""
+    pytester.makepyfile("""
+        def test_service(request, watcher_getter):
+            watcher_getter('sleep', ['10'], checker=lambda: True, request=request)
+    """)
+    result = pytester.runpytest('--services-timings=timings.json')
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines([
+        '*services timings*',
+        'worker*kind*name*ready*checks*teardown*killed',
+        'local*service*sleep*1*no',
+    ])
+    with open(str(pytester.path / 'timings.json')) as fd:
+        timings = json.load(fd)
+    assert [(timing['kind'], timing['name'], timing['attempts']) for timing in timings] == [('service', 'sleep', 1)]
+    assert timings[0]['teardown'] is not None
+
+
+def test_services_trace(pytester):
+    """Test the Trace Event Format profile of the service fixtures."""
+    pytester.makepyfile("""
+        def test_service(request, watcher_getter, port_getter):
+            watcher_getter('sleep', ['10'], checker=lambda: True, request=request)
+            port_getter()
+    """)
+    result = pytester.runpytest('--services-trace=trace.json')
+    result.assert_outcomes(passed=1)
+    with open(str(pytester.path / 'trace.json')) as fd:
+        events = json.load(fd)['traceEvents']
+    assert events[0] == dict(name='thread_name', ph='M', pid=1, tid=0, args=dict(name='local'))
+    spans = {event['name']: event for event in events if event['ph'] == 'X'}
+    assert spans['watcher_getter']['args'] == dict(name='sleep')
+    assert spans['teardown']['args'] == dict(name='sleep')
+    assert spans['lock_resource']['args']['name'] == 'port'
+    assert spans['lock_resource']['tid'] == 0
+
+
+def test_services_parallel_teardown(pytester):
+    """Test that the session services are stopped at once, the ones which don't exit in time are killed."""
+    pytester.makepyfile("""
+        import pytest
+
+        @pytest.fixture(scope='session')
+        def services(request, watcher_getter):
+            return [
+                watcher_getter(
+                    'sh', ['-c', 'trap "" TERM; exec sleep 10'], timeout=2, checker=lambda: True, request=request)
+                for _ in range(5)
+            ]
+
+        def test_services(services):
+            pass
+    """)
+    start = time.monotonic()
+    result = pytester.runpytest('--services-parallel-teardown', '--services-timings=timings.json')
+    # serial teardown would take a second per service
+    assert time.monotonic() - start < 4
+    result.assert_outcomes(passed=1)
+    with open(str(pytester.path / 'timings.json')) as fd:
+        timings = json.load(fd)
+    assert [timing['killed'] for timing in timings] == [True] * 5
+
+
+def test_services_parallel_teardown_waits_for_fixtures(pytester):
+    """Test that the services are not stopped before the fixtures using them are torn down."""
+    pytester.makepyfile("""
+        import pytest
+
+        @pytest.fixture(scope='session')
+        def db(request, watcher_getter):
+            return watcher_getter('sleep', ['10'], timeout=2, checker=lambda: True, request=request)
+
+        @pytest.fixture(scope='session')
+        def app(db):
+            yield
+            assert db.poll() is None, 'db was killed before app teardown'
+
+        @pytest.fixture(scope='session')
+        def cache(request, app, watcher_getter):
+            return watcher_getter('sleep', ['10'], timeout=2, checker=lambda: True, request=request)
+
+        def test_app(cache):
+            pass
+    """)
+    result = pytester.runpytest('--services-parallel-teardown')
+    result.assert_outcomes(passed=1)
+
+
+def test_services_teardown_dependency_order():
+    """Test that a service is stopped after the services depending on it."""
+    stopped = []
+
+    class Watcher(object):
+        def __init__(self, name):
+            self.name = name
+            self.returncode = None
+            self.timing = {}
+
+        def terminate(self):
+            stopped.append(self.name)
+            self.returncode = 0
+
+        def communicate(self, timeout=None):
+            return None, None
+
+        def poll(self):
+            return self.returncode
+
+    teardown = ServicesTeardown(enabled=True)
+    database, cache, app = Watcher('database'), Watcher('cache'), Watcher('app')
+    teardown.register(database, 20)
+    teardown.register(cache, 20)
+    teardown.register(app, 20, depends_on=[database, cache])
+    teardown.final = True
+    assert teardown.stop(app)
+    assert teardown.stop(cache)
+    assert stopped == []
+    assert teardown.stop(database)
+    assert stopped == ['app', 'database', 'cache']
+    assert not teardown.stop(app)
+
+
+def test_services_lock_contention(pytester):
+    """Test the lock contention summary and hook."""
+    pytester.makeconftest("""
+        import json
+
+        def pytest_services_lock_contention(config, records):
+            with open('contention.json', 'w') as fd:
+                json.dump(records, fd)
+    """)
+    pytester.makepyfile("""
+        def test_ports(port_getter):
+            port_getter()
+            port_getter()
+    """)
+    result = pytester.runpytest()
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines([
+        '*services lock contention*',
+        'worker*kind*lock*acquired*retries*timeouts*slept*max wait*',
+        'local*file_lock*port*4*0*0*',
+    ])
+    with open(str(pytester.path / 'contention.json')) as fd:
+        records = {(record['kind'], record['lock']): record for record in json.load(fd)}
+    assert records[('lock_resource', 'port')]['acquisitions'] == 2
+    assert sum(records[('lock_resource', 'port')]['waits']) == 2
+
+
+def test_lock_contention_aggregate():
+    """Test that the lock contention of the workers is summed up per lock."""
+    first, second = LockContention('gw0'), LockContention('gw1')
+    first.record('file_lock', '/tmp/port', 0.0005, 0, 0)
+    second.record('file_lock', '/tmp/port', 0.2, 2, 0.15)
+    second.record('file_lock', '/tmp/port', 25, 200, 20, acquired=False)
+    [total] = aggregate(first.records + second.records)
+    assert (total['worker'], total['acquisitions'], total['retries'], total['timeouts']) == ('*', 2, 202, 1)
+    assert (total['slept'], total['max_wait'], total['waits']) == (20.15, 25, [1, 0, 0, 1, 1])
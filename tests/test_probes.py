@@ -0,0 +1,29 @@
+"""Tests for the probe cache of the service binaries."""
+import os
+import stat
+
+from pytest_services.probes import ProbeCache, version
+
+
+def test_probe_cache(tmp_path):
+    """Test that the probe runs once per binary update across the caches."""
+    executable = tmp_path / 'service'
+    executable.write_text('#!/bin/sh\necho "service 1.0"\n')
+    executable.chmod(executable.stat().st_mode | stat.S_IEXEC)
+    calls = []
+
+    def probe(path):
+        calls.append(path)
+        return version(path)
+
+    path = str(tmp_path / 'probes.json')
+    assert ProbeCache(path).probe(str(executable), 'version', probe) == 'service 1.0'
+    assert ProbeCache(path).probe(str(executable), 'version', probe) == 'service 1.0'
+    assert calls == [str(executable)]
+
+    executable.write_text('#!/bin/sh\necho "service 2.0.0"\n')
+    cache = ProbeCache(path)
+    assert cache.probe(str(executable), 'version', probe) == 'service 2.0.0'
+    assert cache.probe(str(executable), 'version', probe) == 'service 2.0.0'
+    assert len(calls) == 2
+    assert os.path.exists(path)
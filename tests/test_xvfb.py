@@ -0,0 +1,135 @@
+"""Tests for the pool of the pre-warmed Xvfb servers."""
+import logging
+import os
+import socket
+import sys
+import time
+
+import psutil
+import pytest
+
+from pytest_services.broker import ensure_broker, get_broker_socket, lease_service
+from pytest_services.checkers import TCPConnect
+from pytest_services.folders import get_lock_dir
+from pytest_services.xvfb import xvfb_arguments
+
+FAKE_XVFB = """#!{python}
+import socket, sys
+if '-__sentinel_parameter__' in sys.argv:
+    sys.stderr.write('Unrecognized option: -__sentinel_parameter__\\n')
+    sys.exit(1)
+display = int(next(argument for argument in sys.argv[1:] if argument.startswith(':'))[1:])
+sock = socket.socket()
+sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+sock.bind(('127.0.0.1', 6000 + display))
+sock.listen(5)
+while True:
+    sock.accept()[0].close()
+"""
+
+CONFTEST = """
+import pytest
+
+@pytest.fixture(scope='session')
+def memory_root_dir():
+    return {root!r}
+"""
+
+
+def free_display(count):
+    """The display whose TCP port and the ports of the following displays are free."""
+    while True:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        if port + count < 65536 and all(
+                not TCPConnect('127.0.0.1', other)() for other in range(port, port + count)):
+            return port - 6000
+
+
+def gone(pid):
+    """Check whether the process is not running."""
+    try:
+        return psutil.Process(pid).status() == psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return True
+
+
+@pytest.fixture
+def fake_xvfb(tmp_path, monkeypatch):
+    """Fake Xvfb executable, listening on the TCP port of the display."""
+    directory = tmp_path / 'bin'
+    directory.mkdir()
+    executable = directory / 'Xvfb'
+    executable.write_text(FAKE_XVFB.format(python=sys.executable))
+    executable.chmod(0o755)
+    monkeypatch.setenv('PATH', '{0}{1}{2}'.format(directory, os.pathsep, os.environ['PATH']))
+    return str(executable)
+
+
+@pytest.fixture
+def memory_root(tmp_path):
+    """Memory root dir of the test session, isolating its service broker."""
+    path = tmp_path / 'memory'
+    path.mkdir()
+    return str(path)
+
+
+def test_xvfb_pool_lease(pytester, fake_xvfb, memory_root):
+    """Test that the display is leased from the pool, the other displays are prewarmed and the clients killed.
+
+    The detached services with the display in their environment are not killed.
+    """
+    display = free_display(2)
+    pytester.makeconftest(CONFTEST.format(root=memory_root))
+    pytester.makepyfile("""
+        import subprocess
+
+        def test_pool(xvfb, xvfb_display, xvfb_pool_lease):
+            assert xvfb is xvfb_pool_lease
+            assert xvfb_display == {display}
+            for name, detached in (('client', False), ('service', True)):
+                process = subprocess.Popen(['sleep', '60'], start_new_session=detached)
+                with open(name + '.pid', 'w') as fd:
+                    fd.write(str(process.pid))
+    """.format(display=display))
+    result = pytester.runpytest(
+        '--run-services', '--xvfb-pool=2', '--xvfb-pool-display={0}'.format(display),
+        '--services-broker-idle-timeout=5')
+    result.assert_outcomes(passed=1)
+
+    client, service = (int((pytester.path / name).read_text()) for name in ('client.pid', 'service.pid'))
+    try:
+        deadline = time.monotonic() + 5
+        while not gone(client) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert gone(client)
+        assert not gone(service)
+    finally:
+        psutil.Process(service).kill()
+    assert TCPConnect('127.0.0.1', 6000 + display + 1).wait(10)
+
+
+def test_xvfb_pool_fallback(pytester, fake_xvfb, memory_root):
+    """Test that the usual Xvfb is started when all the displays of the pool are leased."""
+    display = free_display(1)
+    lock_dir = get_lock_dir(memory_root)
+    os.mkdir(lock_dir)
+    broker = get_broker_socket(memory_root)
+    ensure_broker(broker, lock_dir, 5, logging.getLogger(__name__))
+    lease = lease_service(
+        broker, [fake_xvfb] + xvfb_arguments(display, (1366, 768, 8), ['-listen', 'TCP'], nolock=False))
+    pytester.makeconftest(CONFTEST.format(root=memory_root))
+    pytester.makepyfile("""
+        def test_fallback(xvfb, xvfb_display, xvfb_pool_lease):
+            assert xvfb_pool_lease is None
+            assert xvfb_display != {display}
+            assert xvfb.poll() is None
+    """.format(display=display))
+    try:
+        result = pytester.runpytest(
+            '--run-services', '--xvfb-pool=1', '--xvfb-pool-display={0}'.format(display),
+            '--services-broker-idle-timeout=5')
+    finally:
+        lease.terminate()
+    result.assert_outcomes(passed=1)